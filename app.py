@@ -1,41 +1,1033 @@
-import os, json, logging
-from typing import List, TypedDict, Optional
+import os, re, json, math, time, zlib, random, hashlib, logging, sqlite3, tempfile, threading
+from collections import Counter, OrderedDict, deque
+from contextlib import contextmanager
+from contextvars import ContextVar
+from email.utils import parsedate_to_datetime
+from concurrent.futures import FIRST_COMPLETED, ThreadPoolExecutor, wait
+from typing import Callable, Iterator, List, TypedDict, Optional, Tuple, Union
+
+from urllib.parse import parse_qsl, urlencode, urlsplit, urlunsplit
 
 try:
     import requests
+    from requests.adapters import HTTPAdapter
     _HAVE_REQUESTS = True
 except ModuleNotFoundError:
-    import urllib.request, urllib.error
     _HAVE_REQUESTS = False
 
-from groq import Groq
-from flask import Flask, render_template, request, jsonify
+try:
+    import numpy as np
+    _HAVE_NUMPY = True
+except ModuleNotFoundError:
+    _HAVE_NUMPY = False
+
+try:
+    import tiktoken
+    _HAVE_TIKTOKEN = True
+except ModuleNotFoundError:
+    _HAVE_TIKTOKEN = False
+
+try:
+    import h2  # noqa: F401 – only needed for optional HTTP/2 transports
+    HAVE_H2 = True
+except ModuleNotFoundError:
+    HAVE_H2 = False
+
+import httpx
+from groq import Groq, DefaultHttpxClient, APIConnectionError, APITimeoutError
+from flask import Flask, Response, render_template, request, jsonify, stream_with_context
 
 app = Flask(__name__)
 app.logger.setLevel(logging.INFO)
 
+# ---------- Settings ----------
+# Every setting is read once at import: from the environment, else from the
+# JSON file named by BOOG_CONFIG ({"GROQ_MODEL": "...", "TAVILY_URL": "..."}),
+# else the default below. API keys are only read from the environment.
+def _load_config_file(path: str) -> dict:
+    if not path:
+        return {}
+    try:
+        with open(path, encoding="utf-8") as f:
+            data = json.load(f)
+    except (OSError, ValueError) as e:
+        app.logger.warning("Ignoring BOOG_CONFIG %s: %s", path, e)
+        return {}
+    if not isinstance(data, dict):
+        app.logger.warning("Ignoring BOOG_CONFIG %s: expected a JSON object", path)
+        return {}
+    return data
+
+_CONFIG_FILE = _load_config_file(os.getenv("BOOG_CONFIG", ""))
+
+def _setting(name: str, default):
+    v = os.getenv(name)
+    return _CONFIG_FILE.get(name, default) if v is None else v
+
+def _env_str(name: str, default: str) -> str:
+    return str(_setting(name, default))
+
+def _env_int(name: str, default: int) -> int:
+    try:
+        return int(_setting(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def _env_float(name: str, default: float) -> float:
+    try:
+        return float(_setting(name, default))
+    except (TypeError, ValueError):
+        return default
+
+def _env_bool(name: str, default: bool) -> bool:
+    v = _setting(name, default)
+    return v if isinstance(v, bool) else str(v).strip().lower() in ("1", "true", "yes", "on")
+
+TAVILY_URL = _env_str("TAVILY_URL", "https://api.tavily.com/search")
+GROQ_BASE_URL = _env_str("GROQ_BASE_URL", "https://api.groq.com")
+GROQ_MODEL = _env_str("GROQ_MODEL", "openai/gpt-oss-120b")
+AI_MODEL = _env_str("AI_MODEL", GROQ_MODEL)
+WEB_MODEL = _env_str("WEB_MODEL", GROQ_MODEL)
+
+GROQ_POOL_SIZE = _env_int("GROQ_POOL_SIZE", 20)
+GROQ_KEEPALIVE_S = _env_float("GROQ_KEEPALIVE_S", 30.0)
+GROQ_HTTP2 = _env_bool("GROQ_HTTP2", False)
+TAVILY_POOL_SIZE = _env_int("TAVILY_POOL_SIZE", 10)
+TAVILY_HTTP2 = _env_bool("TAVILY_HTTP2", False)
+TAVILY_PREWARM = _env_int("TAVILY_PREWARM", 1)
+SEARCH_CACHE_TTL_S = _env_float("SEARCH_CACHE_TTL_S", 600.0)
+SEARCH_CACHE_MAX_ENTRIES = _env_int("SEARCH_CACHE_MAX_ENTRIES", 1024)
+SEARCH_CACHE_MAX_BYTES = _env_int("SEARCH_CACHE_MAX_BYTES", 8 * 1024 * 1024)
+SHARED_CACHE_PATH = _env_str("SHARED_CACHE_PATH", os.path.join(tempfile.gettempdir(), "boog-cache.sqlite3"))
+SHARED_CACHE_MAX_BYTES = _env_int("SHARED_CACHE_MAX_BYTES", 64 * 1024 * 1024)
+SHARED_CACHE_COMPACT_S = _env_float("SHARED_CACHE_COMPACT_S", 300.0)
+ANSWER_CACHE_TTL_S = _env_float("ANSWER_CACHE_TTL_S", 900.0)
+WEB_ANSWER_SOFT_TTL_S = _env_float("WEB_ANSWER_SOFT_TTL_S", 300.0)
+WEB_ANSWER_HARD_TTL_S = _env_float("WEB_ANSWER_HARD_TTL_S", 3600.0)
+REFRESH_WORKERS = _env_int("REFRESH_WORKERS", 2)
+REQUEST_DEADLINE_S = _env_float("REQUEST_DEADLINE_S", 20.0)
+REQUEST_DEADLINE_MAX_S = _env_float("REQUEST_DEADLINE_MAX_S", 60.0)
+REQUEST_DEADLINE_MIN_S = _env_float("REQUEST_DEADLINE_MIN_S", 2.0)
+SEARCH_BUDGET_SHARE = _env_float("SEARCH_BUDGET_SHARE", 0.4)
+SEARCH_TIMEOUT_S = _env_float("SEARCH_TIMEOUT_S", 12.0)
+TAVILY_RETRIES = _env_int("TAVILY_RETRIES", 2)
+TAVILY_BACKOFF_S = _env_float("TAVILY_BACKOFF_S", 0.2)
+TAVILY_BACKOFF_MAX_S = _env_float("TAVILY_BACKOFF_MAX_S", 2.0)
+TAVILY_HEDGE = _env_bool("TAVILY_HEDGE", False)
+TAVILY_HEDGE_MIN_S = _env_float("TAVILY_HEDGE_MIN_S", 0.25)
+BREAKER = _env_bool("BREAKER", True)
+BREAKER_WINDOW_S = _env_float("BREAKER_WINDOW_S", 30.0)
+BREAKER_MIN_CALLS = _env_int("BREAKER_MIN_CALLS", 5)
+BREAKER_FAILURE_RATE = _env_float("BREAKER_FAILURE_RATE", 0.5)
+BREAKER_SLOW_S = _env_float("BREAKER_SLOW_S", 8.0)
+BREAKER_MIN_VERDICT_S = _env_float("BREAKER_MIN_VERDICT_S", 1.5)
+BREAKER_OPEN_S = _env_float("BREAKER_OPEN_S", 15.0)
+MIN_LLM_BUDGET_S = _env_float("MIN_LLM_BUDGET_S", 1.0)
+ADMIT_CONCURRENCY = _env_int("ADMIT_CONCURRENCY", 32)
+ADMIT_QUEUE = _env_int("ADMIT_QUEUE", 64)
+ADMIT_MAX_WAIT_S = _env_float("ADMIT_MAX_WAIT_S", 5.0)
+METRICS_DIR = _env_str("METRICS_DIR", os.path.join(tempfile.gettempdir(), "boog-metrics"))
+METRICS_FLUSH_S = _env_float("METRICS_FLUSH_S", 5.0)
+SEMANTIC_CACHE = _env_bool("SEMANTIC_CACHE", True) and _HAVE_NUMPY
+SEMANTIC_CAPACITY = _env_int("SEMANTIC_CAPACITY", 2048)
+SEMANTIC_THRESHOLD_AI = _env_float("SEMANTIC_THRESHOLD_AI", 0.95)
+SEMANTIC_THRESHOLD_WEB = _env_float("SEMANTIC_THRESHOLD_WEB", 0.90)
+PROMPT_TOKEN_BUDGET = _env_int("PROMPT_TOKEN_BUDGET", 900)
+PROMPT_TOKENIZER = _env_str("PROMPT_TOKENIZER", "o200k_base")
+SNIPPET_MAX_CHARS = _env_int("SNIPPET_MAX_CHARS", 1200)
+ROUTE_WEB_THRESHOLD = _env_float("ROUTE_WEB_THRESHOLD", 0.5)
+ROUTE_EXAMPLES_PATH = _env_str("ROUTE_EXAMPLES_PATH", "")
+SEARCH_DEPTH = _env_str("SEARCH_DEPTH", "auto")
+ESCALATE_BELOW = _env_float("ESCALATE_BELOW", 0.5)
+ESCALATE_RACE = _env_bool("ESCALATE_RACE", False)
+FANOUT = _env_bool("FANOUT", False)
+FANOUT_MAX_QUERIES = _env_int("FANOUT_MAX_QUERIES", 3)
+FANOUT_WORKERS = _env_int("FANOUT_WORKERS", 8)
+DEDUP = _env_bool("DEDUP", True)
+DEDUP_SIMHASH_DISTANCE = _env_int("DEDUP_SIMHASH_DISTANCE", 10)
+RERANK = _env_bool("RERANK", True)
+RERANK_FETCH_K = _env_int("RERANK_FETCH_K", 8)
+RERANK_MMR_LAMBDA = _env_float("RERANK_MMR_LAMBDA", 0.7)
+RERANK_DUP_SIMILARITY = _env_float("RERANK_DUP_SIMILARITY", 0.8)
+
+# ---------- Stats ----------
+_stats_lock = threading.Lock()
+
+def count_stat(stats: dict, key: str, n: int = 1) -> None:
+    with _stats_lock:
+        stats[key] = stats.get(key, 0) + n
+
+# ---------- Deadlines ----------
+class Deadline:
+    """Time budget of one request; each stage takes its timeout from what is left."""
+
+    def __init__(self, seconds: float):
+        self.expires = time.monotonic() + seconds
+
+    def remaining(self) -> float:
+        return max(0.0, self.expires - time.monotonic())
+
+    def expired(self) -> bool:
+        return self.remaining() <= 0.0
+
+    def budget(self, share: float = 1.0, cap: Optional[float] = None) -> float:
+        t = self.remaining() * share
+        return min(t, cap) if cap is not None else t
+
+# Raised by the HTTP layers, the Groq SDK and SingleFlight waiters on timeout.
+TIMEOUT_ERRORS: tuple = (TimeoutError, httpx.TimeoutException, APITimeoutError)
+if _HAVE_REQUESTS:
+    TIMEOUT_ERRORS += (requests.exceptions.Timeout,)
+
+# Raised when no response arrived at all (refused, reset, DNS); safe to retry.
+_CONNECTION_ERRORS: tuple = (ConnectionError, httpx.TransportError, APIConnectionError)
+if _HAVE_REQUESTS:
+    _CONNECTION_ERRORS += (requests.exceptions.ConnectionError,)
+
+TIMEOUT_MSG = "Sorry, that took too long to answer. Please try again in a moment."
+TRUNCATED_MSG = "\n\n_(Answer cut short: the response time budget ran out.)_"
+SEARCH_TIMEOUT_NOTE = "_(Web search timed out, so this answer is not grounded in sources.)_\n\n"
+SEARCH_DOWN_NOTE = "_(Web search is unavailable right now, so this answer is not grounded in sources.)_\n\n"
+LLM_DOWN_MSG = "Sorry, Boog's AI is temporarily unavailable. Please try again in a moment."
+
+# ---------- Metrics ----------
+LATENCY_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 20.0, 30.0)
+TOKEN_BUCKETS = (128, 256, 512, 1024, 2048, 4096, 8192, 16384)
+ROUTE_BUCKETS = (0.00005, 0.0001, 0.00025, 0.0005, 0.001, 0.0025, 0.005, 0.01)
+METRIC_BUCKETS = {"boog_prompt_tokens": TOKEN_BUCKETS, "boog_route_seconds": ROUTE_BUCKETS}  # not the latency default
+METRIC_HELP = {
+    "boog_stage_seconds": ("histogram", "Latency of one /chat stage (queue, search, escalation, dedup, rerank, prompt, llm, llm_first_token, serialize, total)."),
+    "boog_upstream_calls_total": ("counter", "Upstream calls by upstream and HTTP status ('timeout'/'error'/'cancelled' when there was none)."),
+    "boog_llm_tokens_total": ("counter", "Groq tokens by direction (in = prompt, out = completion)."),
+    "boog_tavily_credits_total": ("counter", "Tavily API credits spent by search depth (basic = 1, advanced = 2)."),
+    "boog_route_seconds": ("histogram", "Time to route an auto-mode message, by decision (ai/web) and deciding rule (heuristic/model)."),
+    "boog_prompt_tokens": ("histogram", "Estimated tokens of each web-search synthesis prompt."),
+    "boog_cache_events_total": ("counter", "Cache outcomes (hits, misses, evictions, ...) by cache."),
+    "boog_events_total": ("counter", "Other per-feature counters (coalescing, refreshes, connections, ...)."),
+    "boog_admission_wait_seconds": ("histogram", "Time a /chat request waited for a slot, by outcome (admitted/shed)."),
+    "boog_admission_in_flight": ("gauge", "/chat requests being answered."),
+    "boog_admission_queue_depth": ("gauge", "/chat requests waiting for a slot."),
+}
+
+def _pid_alive(pid: str) -> bool:
+    """False only when pid is a number and no such process exists."""
+    try:
+        os.kill(int(pid), 0)
+    except ProcessLookupError:
+        return False
+    except (ValueError, OSError):
+        pass
+    return True
+
+class Metrics:
+    """
+    Per-worker counters and histograms. Each worker periodically writes a JSON
+    snapshot to METRICS_DIR/<pid>.json; /metrics sums all snapshots, so any
+    worker can answer for the whole server. Recording is one dict update under
+    a short lock.
+    """
+
+    def __init__(self, directory: str, flush_every: float):
+        self.directory = directory
+        self.flush_every = flush_every
+        self.collectors: List[Callable[[], Iterator[tuple]]] = []  # -> (name, labels, value)
+        self._counters: dict = {}  # (name, labels) -> value
+        self._hists: dict = {}     # (name, labels) -> [bucket counts..., sum, count]
+        self._lock = threading.Lock()
+        self._flusher_pid = 0
+
+    def inc(self, name: str, n: float = 1, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + n
+        self._ensure_flusher()
+
+    def observe(self, name: str, value: float, **labels) -> None:
+        key = (name, tuple(sorted(labels.items())))
+        buckets = METRIC_BUCKETS.get(name, LATENCY_BUCKETS)
+        i = next((i for i, b in enumerate(buckets) if value <= b), len(buckets))
+        with self._lock:
+            h = self._hists.get(key)
+            if h is None:
+                h = self._hists[key] = [0] * (len(buckets) + 3)
+            h[i] += 1
+            h[-2] += value
+            h[-1] += 1
+        self._ensure_flusher()
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            counters = [[n, list(l), v] for (n, l), v in self._counters.items()]
+            hists = [[n, list(l), list(h)] for (n, l), h in self._hists.items()]
+        for collect in self.collectors:
+            for name, labels, value in collect():
+                counters.append([name, sorted(labels.items()), value])
+        return {"counters": counters, "hists": hists}
+
+    def flush(self) -> None:
+        os.makedirs(self.directory, exist_ok=True)
+        path = os.path.join(self.directory, f"{os.getpid()}.json")
+        with open(path + ".tmp", "w") as fh:
+            json.dump(self.snapshot(), fh)
+        os.replace(path + ".tmp", path)
+
+    def _ensure_flusher(self) -> None:
+        pid = os.getpid()
+        if self._flusher_pid == pid or self.flush_every <= 0:
+            return
+        self._flusher_pid = pid
+
+        def loop() -> None:
+            while True:
+                time.sleep(self.flush_every)
+                try:
+                    self.flush()
+                except OSError as exc:
+                    app.logger.warning("Metrics flush failed: %s", exc)
+
+        threading.Thread(target=loop, name="metrics-flusher", daemon=True).start()
+
+    def collect(self) -> Tuple[dict, dict]:
+        """Counters and histograms summed over every worker's latest snapshot."""
+        snapshots = [self.snapshot()]
+        own = f"{os.getpid()}.json"
+        try:
+            names = [n for n in os.listdir(self.directory) if n.endswith(".json") and n != own]
+        except OSError:
+            names = []
+        for name in names:
+            try:
+                with open(os.path.join(self.directory, name)) as fh:
+                    snap = json.load(fh)
+            except (OSError, ValueError):
+                continue
+            # A dead worker's counters still count towards the totals, but its
+            # gauges (in-flight chats, queue depth) describe load that is gone.
+            if not _pid_alive(name[:-len(".json")]):
+                snap["counters"] = [c for c in snap["counters"]
+                                    if METRIC_HELP.get(c[0], ("counter",))[0] != "gauge"]
+            snapshots.append(snap)
+        counters: dict = {}
+        hists: dict = {}
+        for snap in snapshots:
+            for name, labels, value in snap["counters"]:
+                key = (name, tuple(map(tuple, labels)))
+                counters[key] = counters.get(key, 0) + value
+            for name, labels, h in snap["hists"]:
+                key = (name, tuple(map(tuple, labels)))
+                acc = hists.setdefault(key, [0] * len(h))
+                for i, v in enumerate(h):
+                    acc[i] += v
+        return counters, hists
+
+    def render(self) -> str:
+        """Prometheus text exposition format (0.0.4)."""
+        counters, hists = self.collect()
+
+        def fmt(labels, extra=()) -> str:
+            pairs = [*labels, *extra]
+            if not pairs:
+                return ""
+            return "{" + ",".join(f'{k}="{v}"' for k, v in pairs) + "}"
+
+        out = []
+        for name in sorted({n for n, _ in counters} | {n for n, _ in hists}):
+            kind, help_text = METRIC_HELP.get(name, ("counter", name))
+            out.append(f"# HELP {name} {help_text}")
+            out.append(f"# TYPE {name} {kind}")
+            for (n, labels), value in sorted(counters.items()):
+                if n == name:
+                    out.append(f"{name}{fmt(labels)} {value}")
+            for (n, labels), h in sorted(hists.items()):
+                if n != name:
+                    continue
+                cumulative = 0
+                for bound, count in zip((*METRIC_BUCKETS.get(name, LATENCY_BUCKETS), "+Inf"), h):
+                    cumulative += count
+                    out.append(f"{name}_bucket{fmt(labels, [('le', bound)])} {cumulative}")
+                out.append(f"{name}_sum{fmt(labels)} {h[-2]}")
+                out.append(f"{name}_count{fmt(labels)} {h[-1]}")
+        return "\n".join(out) + "\n"
+
+metrics = Metrics(METRICS_DIR, METRICS_FLUSH_S)
+
+# Stage durations of the current request, for its Server-Timing header.
+# Non-float values are descriptions (e.g. prompt_tokens) rather than durations.
+_request_timings: ContextVar[Optional[dict]] = ContextVar("request_timings", default=None)
+
+def begin_timings() -> dict:
+    timings: dict = {}
+    _request_timings.set(timings)
+    return timings
+
+def note_timing(name: str, desc) -> None:
+    timings = _request_timings.get()
+    if timings is not None:
+        timings[name] = str(desc)
+
+def server_timing(timings: dict) -> str:
+    return ", ".join(
+        f'{name};desc="{v}"' if isinstance(v, str) else f"{name};dur={v * 1000:.1f}"
+        for name, v in timings.items()
+    )
+
+@contextmanager
+def stage(name: str):
+    """Record the duration of a /chat stage in boog_stage_seconds and the request's timings."""
+    t0 = time.perf_counter()
+    try:
+        yield
+    finally:
+        dt = time.perf_counter() - t0
+        metrics.observe("boog_stage_seconds", dt, stage=name)
+        timings = _request_timings.get()
+        if timings is not None:
+            timings[name] = timings.get(name, 0.0) + dt
+
+def _status_label(exc: BaseException) -> str:
+    if isinstance(exc, TIMEOUT_ERRORS):
+        return "timeout"
+    code = getattr(exc, "status_code", None) or getattr(getattr(exc, "response", None), "status_code", None)
+    return str(code) if code else "error"
+
+@contextmanager
+def upstream_call(upstream: str):
+    """Count one call to upstream by its outcome in boog_upstream_calls_total."""
+    try:
+        yield
+    except CircuitOpenError:
+        raise  # rejected before any call was made
+    except BaseException as exc:  # GeneratorExit / CancelledError: the client went away
+        status = _status_label(exc) if isinstance(exc, Exception) else "cancelled"
+        metrics.inc("boog_upstream_calls_total", upstream=upstream, status=status)
+        raise
+    metrics.inc("boog_upstream_calls_total", upstream=upstream, status="200")
+
+def record_usage(usage) -> None:
+    global _completion_tokens_avg
+    if usage is None:
+        return
+    completion = getattr(usage, "completion_tokens", 0) or 0
+    metrics.inc("boog_llm_tokens_total", getattr(usage, "prompt_tokens", 0) or 0, direction="in")
+    metrics.inc("boog_llm_tokens_total", completion, direction="out")
+    if completion:
+        _completion_tokens_avg += 0.1 * (completion - _completion_tokens_avg)
+
+# ---------- Cancellation ----------
+# A client that disconnects mid-answer closes the response generator (WSGI)
+# or sends http.disconnect (ASGI); the Groq stream is closed right away. The
+# tokens it would still have produced are estimated from the running average
+# completion length.
+CANCEL_STATS = {"requests": 0, "llm_streams": 0, "tokens_streamed": 0, "tokens_saved_est": 0}
+_completion_tokens_avg = 0.0
+
+def record_cancelled_stream(streamed: int) -> None:
+    """A completion stream was abandoned after `streamed` deltas (about one token each)."""
+    count_stat(CANCEL_STATS, "llm_streams")
+    count_stat(CANCEL_STATS, "tokens_streamed", streamed)
+    count_stat(CANCEL_STATS, "tokens_saved_est", max(0, round(_completion_tokens_avg) - streamed))
+
+# ---------- Admission control ----------
+# Each worker answers at most ADMIT_CONCURRENCY chats at once. Up to
+# ADMIT_QUEUE more wait for a slot, each for at most ADMIT_MAX_WAIT_S and never
+# so long that its deadline would leave the model under MIN_LLM_BUDGET_S.
+# Beyond that a request is shed at once with 503 and a Retry-After estimated
+# from the queue length and recent service times, instead of queueing
+# invisibly until the client gives up.
+ADMISSION_STATS = {"admitted": 0, "queued": 0, "shed_queue_full": 0, "shed_timeout": 0}
+ADMISSION_LOAD = {"in_flight": 0, "waiting": 0}  # current values, exported as gauges
+OVERLOADED_MSG = "Boog is very busy right now. Please try again in a few seconds."
+_service_s_avg = 1.0
+
+class Overloaded(Exception):
+    """No slot for this request: answer 503 with Retry-After."""
+
+    def __init__(self, reason: str):
+        super().__init__(f"overloaded ({reason})")
+        self.reason = reason  # "queue_full" | "timeout"
+
+def admission_wait(deadline: Deadline) -> float:
+    """How long a request may wait for a slot."""
+    return max(0.0, min(ADMIT_MAX_WAIT_S, deadline.remaining() - MIN_LLM_BUDGET_S))
+
+def retry_after() -> int:
+    """Seconds until the current backlog should have drained."""
+    with _stats_lock:
+        backlog = ADMISSION_LOAD["waiting"] + 1
+        service = _service_s_avg
+    return max(1, min(60, math.ceil(backlog * service / max(1, ADMIT_CONCURRENCY))))
+
+def record_admission(waited: float, reason: Optional[str] = None) -> None:
+    """One admission decision: admitted when reason is None, else shed for reason."""
+    metrics.observe("boog_admission_wait_seconds", waited, outcome="shed" if reason else "admitted")
+    count_stat(ADMISSION_STATS, "shed_" + reason if reason else "admitted")
+
+def record_service_time(seconds: float) -> None:
+    global _service_s_avg
+    with _stats_lock:
+        _service_s_avg += 0.1 * (seconds - _service_s_avg)
+
+class AdmissionController:
+    """Bounded slots plus a bounded wait queue for the threaded server."""
+
+    def __init__(self, limit: int, queue: int):
+        self.limit = limit
+        self.queue = queue
+        self._cond = threading.Condition()
+        self._active = 0
+        self._waiting = 0
+
+    def acquire(self, deadline: Deadline) -> float:
+        """Wait for a slot; returns when it was granted, or raises Overloaded."""
+        t0 = time.monotonic()
+        if self.limit <= 0:
+            return t0
+        with self._cond:
+            if self._active >= self.limit:
+                if self._waiting >= self.queue:
+                    record_admission(0.0, "queue_full")
+                    raise Overloaded("queue_full")
+                self._waiting += 1
+                count_stat(ADMISSION_STATS, "queued")
+                count_stat(ADMISSION_LOAD, "waiting")
+                try:
+                    admitted = self._cond.wait_for(lambda: self._active < self.limit, admission_wait(deadline))
+                finally:
+                    self._waiting -= 1
+                    count_stat(ADMISSION_LOAD, "waiting", -1)
+                if not admitted:
+                    record_admission(time.monotonic() - t0, "timeout")
+                    raise Overloaded("timeout")
+            self._active += 1
+        count_stat(ADMISSION_LOAD, "in_flight")
+        now = time.monotonic()
+        record_admission(now - t0)
+        return now
+
+    def release(self, admitted_at: float) -> None:
+        if self.limit <= 0:
+            return
+        record_service_time(time.monotonic() - admitted_at)
+        count_stat(ADMISSION_LOAD, "in_flight", -1)
+        with self._cond:
+            self._active -= 1
+            self._cond.notify()
+
+admission = AdmissionController(ADMIT_CONCURRENCY, ADMIT_QUEUE)
+
 # ---------- Models ----------
 class SearchItem(TypedDict):
     title: str
     url: str
     snippet: str
+    score: float  # Tavily relevance, 0..1
 
 # ---------- HTTP helper ----------
-def _post_json(url: str, headers: dict, payload: dict) -> dict:
-    if _HAVE_REQUESTS:
-        r = requests.post(url, headers=headers, json=payload, timeout=12)
-        r.raise_for_status()
-        return r.json()
-    data = json.dumps(payload).encode("utf-8")
-    req = urllib.request.Request(url, data=data, headers=headers, method="POST")
-    with urllib.request.urlopen(req, timeout=12) as resp:  # nosec
-        return json.loads(resp.read().decode("utf-8"))
+# Pooled keep-alive session per worker process (re-created after fork).
+# requests is preferred; httpx (always present via groq) serves as the
+# fallback and as the HTTP/2 transport.
+_session_lock = threading.Lock()
+_session = None
+_session_pid = 0
+
+def _new_session():
+    http2 = TAVILY_HTTP2 and HAVE_H2
+    if TAVILY_HTTP2 and not HAVE_H2:
+        app.logger.warning("TAVILY_HTTP2 is set but 'h2' is not installed; using HTTP/1.1")
+    if _HAVE_REQUESTS and not http2:
+        s = requests.Session()
+        adapter = HTTPAdapter(pool_connections=4, pool_maxsize=TAVILY_POOL_SIZE)
+        s.mount("https://", adapter)
+        s.mount("http://", adapter)
+        return s
+    return httpx.Client(
+        http2=http2,
+        limits=httpx.Limits(
+            max_connections=TAVILY_POOL_SIZE,
+            max_keepalive_connections=TAVILY_POOL_SIZE,
+        ),
+    )
+
+def _http_session():
+    global _session, _session_pid
+    pid = os.getpid()
+    if _session is not None and _session_pid == pid:
+        return _session
+    with _session_lock:
+        if _session is None or _session_pid != pid:
+            _session = _new_session()
+            _session_pid = pid
+    return _session
+
+def _post_json(url: str, headers: dict, payload: dict, timeout: float = 12) -> dict:
+    r = _http_session().post(url, headers=headers, json=payload, timeout=timeout)
+    r.raise_for_status()
+    return r.json()
+
+def _prewarm(url: str, n: int) -> None:
+    """Open up to n pooled connections to url's origin ahead of the first request."""
+    parts = urlsplit(url)
+    origin = f"{parts.scheme}://{parts.netloc}/"
+    session = _http_session()
+
+    def touch() -> None:
+        try:
+            session.head(origin, timeout=3)
+        except Exception as exc:
+            app.logger.info("Prewarm of %s failed: %s", origin, exc)
+
+    threads = [threading.Thread(target=touch, daemon=True) for _ in range(max(0, n))]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+
+def warm_up() -> None:
+    """Called once per worker after fork (see gunicorn.conf.py)."""
+    _groq()
+    if BREAKER and search_timeout(Deadline(REQUEST_DEADLINE_S)) / (TAVILY_RETRIES + 1) < BREAKER_MIN_VERDICT_S:
+        app.logger.warning("Tavily timeouts at the default deadline are under BREAKER_MIN_VERDICT_S; "
+                           "a hanging Tavily will not open its breaker")
+    shared_cache.start_compactor()
+    threading.Thread(target=_prewarm, args=(TAVILY_URL, TAVILY_PREWARM), daemon=True).start()
+    threading.Thread(target=load_encoder, name="tokenizer-load", daemon=True).start()
+
+# ---------- Caching ----------
+class TTLCache:
+    """Thread-safe LRU with a per-entry TTL, bounded by entry count and total bytes."""
+
+    def __init__(self, max_entries: int, max_bytes: int, ttl: float):
+        self.max_entries = max_entries
+        self.max_bytes = max_bytes
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "evictions": 0, "expirations": 0}
+        self._data: "OrderedDict[str, tuple]" = OrderedDict()  # key -> (expires, size, value)
+        self._bytes = 0
+        self._lock = threading.Lock()
+
+    def get(self, key: str):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is None:
+                self.stats["misses"] += 1
+                return None
+            if entry[0] <= time.monotonic():
+                self._drop(key)
+                self.stats["expirations"] += 1
+                self.stats["misses"] += 1
+                return None
+            self._data.move_to_end(key)
+            self.stats["hits"] += 1
+            return entry[2]
+
+    def set(self, key: str, value, size: int, ttl: Optional[float] = None) -> None:
+        if size > self.max_bytes:
+            return
+        with self._lock:
+            if key in self._data:
+                self._drop(key)
+            self._data[key] = (time.monotonic() + (self.ttl if ttl is None else ttl), size, value)
+            self._bytes += size
+            while len(self._data) > self.max_entries or self._bytes > self.max_bytes:
+                self._drop(next(iter(self._data)))
+                self.stats["evictions"] += 1
+
+    def _drop(self, key: str) -> None:
+        self._bytes -= self._data.pop(key)[1]
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, entries=len(self._data), bytes=self._bytes)
+
+class SharedCache:
+    """
+    Cross-worker cache in one SQLite file (WAL mode), shared by every gunicorn
+    worker and kept across restarts. Failures are logged and read as misses.
+    """
+
+    _SCHEMA = (
+        "CREATE TABLE IF NOT EXISTS cache ("
+        " key TEXT PRIMARY KEY, value TEXT NOT NULL, size INTEGER NOT NULL,"
+        " expires REAL NOT NULL, accessed REAL NOT NULL)",
+        "CREATE INDEX IF NOT EXISTS cache_accessed ON cache(accessed)",
+        "CREATE INDEX IF NOT EXISTS cache_expires ON cache(expires)",
+    )
+    TOUCH_EVERY_S = 60.0  # limits LRU bookkeeping writes on hot keys
+
+    def __init__(self, path: str, max_bytes: int, compact_every: float):
+        self.path = path
+        self.max_bytes = max_bytes
+        self.compact_every = compact_every
+        self.stats = {"hits": 0, "misses": 0, "writes": 0, "errors": 0, "compactions": 0}
+        self._local = threading.local()
+        self._compactor_pid = 0
+
+    def _conn(self) -> sqlite3.Connection:
+        pid = os.getpid()
+        conn = getattr(self._local, "conn", None)
+        if conn is None or self._local.pid != pid:
+            conn = sqlite3.connect(self.path, timeout=0.2, isolation_level=None)
+            conn.execute("PRAGMA journal_mode=WAL")
+            conn.execute("PRAGMA synchronous=NORMAL")
+            conn.execute("PRAGMA auto_vacuum=INCREMENTAL")
+            for stmt in self._SCHEMA:
+                conn.execute(stmt)
+            self._local.conn, self._local.pid = conn, pid
+        return conn
+
+    def get(self, key: str):
+        if not self.path:
+            return None
+        now = time.time()
+        try:
+            conn = self._conn()
+            row = conn.execute(
+                "SELECT value, accessed FROM cache WHERE key = ? AND expires > ?", (key, now)
+            ).fetchone()
+            if row is None:
+                count_stat(self.stats, "misses")
+                return None
+            if now - row[1] > self.TOUCH_EVERY_S:
+                conn.execute("UPDATE cache SET accessed = ? WHERE key = ?", (now, key))
+            count_stat(self.stats, "hits")
+            return json.loads(row[0])
+        except (sqlite3.Error, ValueError) as exc:
+            count_stat(self.stats, "errors")
+            app.logger.warning("Shared cache read failed: %s", exc)
+            return None
+
+    def set(self, key: str, value, ttl: float) -> None:
+        if not self.path:
+            return
+        data = json.dumps(value)
+        now = time.time()
+        try:
+            self._conn().execute(
+                "INSERT OR REPLACE INTO cache (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, data, len(data), now + ttl, now),
+            )
+            count_stat(self.stats, "writes")
+        except sqlite3.Error as exc:
+            count_stat(self.stats, "errors")
+            app.logger.warning("Shared cache write failed: %s", exc)
+        self.start_compactor()
+
+    def add(self, key: str, value, ttl: float) -> bool:
+        """Store only if key is absent or expired; True when this call stored it."""
+        if not self.path:
+            return True
+        now = time.time()
+        try:
+            conn = self._conn()
+            conn.execute("DELETE FROM cache WHERE key = ? AND expires <= ?", (key, now))
+            cur = conn.execute(
+                "INSERT OR IGNORE INTO cache (key, value, size, expires, accessed) VALUES (?, ?, ?, ?, ?)",
+                (key, json.dumps(value), 0, now + ttl, now),
+            )
+            return cur.rowcount == 1
+        except sqlite3.Error as exc:
+            count_stat(self.stats, "errors")
+            app.logger.warning("Shared cache write failed: %s", exc)
+            return False
+
+    def compact(self) -> None:
+        """Drop expired rows, evict least-recently-used rows above max_bytes, shrink the files."""
+        conn = self._conn()
+        conn.execute("DELETE FROM cache WHERE expires <= ?", (time.time(),))
+        total = conn.execute("SELECT COALESCE(SUM(size), 0) FROM cache").fetchone()[0]
+        excess = total - self.max_bytes
+        if excess > 0:
+            doomed = []
+            for key, size in conn.execute("SELECT key, size FROM cache ORDER BY accessed"):
+                doomed.append((key,))
+                excess -= size
+                if excess <= 0:
+                    break
+            conn.executemany("DELETE FROM cache WHERE key = ?", doomed)
+        conn.execute("PRAGMA incremental_vacuum")
+        conn.execute("PRAGMA wal_checkpoint(TRUNCATE)")
+        count_stat(self.stats, "compactions")
+
+    def start_compactor(self) -> None:
+        pid = os.getpid()
+        if self._compactor_pid == pid or self.compact_every <= 0:
+            return
+        self._compactor_pid = pid
+
+        def loop() -> None:
+            while True:
+                time.sleep(self.compact_every)
+                try:
+                    self.compact()
+                except sqlite3.Error as exc:
+                    app.logger.warning("Shared cache compaction failed: %s", exc)
+
+        threading.Thread(target=loop, name="shared-cache-compactor", daemon=True).start()
+
+    def snapshot(self) -> dict:
+        with _stats_lock:
+            stats = dict(self.stats)
+        if self.path:
+            try:
+                entries, size = self._conn().execute(
+                    "SELECT COUNT(*), COALESCE(SUM(size), 0) FROM cache"
+                ).fetchone()
+                stats.update(entries=entries, bytes=size)
+            except sqlite3.Error:
+                pass
+        return stats
+
+class SingleFlight:
+    """Collapse concurrent calls with the same key into one upstream call."""
+
+    class _Call:
+        def __init__(self):
+            self.done = threading.Event()
+            self.result = None
+            self.error: Optional[BaseException] = None
+
+    def __init__(self):
+        self.stats = {"calls": 0, "coalesced": 0}
+        self._calls: dict = {}
+        self._lock = threading.Lock()
+
+    def do(self, key: str, fn: Callable, timeout: Optional[float] = None):
+        """timeout bounds how long a coalesced caller waits for the leader."""
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = self._Call()
+        if not leader:
+            count_stat(self.stats, "coalesced")
+            if not call.done.wait(timeout):
+                raise TimeoutError(f"gave up waiting for in-flight call {key!r}")
+            if call.error is not None:
+                raise call.error
+            return call.result
+
+        count_stat(self.stats, "calls")
+        try:
+            call.result = fn()
+            return call.result
+        except BaseException as exc:
+            call.error = exc
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+
+_CANON_APOS = re.compile(r"['’]")
+_CANON_STRIP = re.compile(r"[^\w\s+#]", re.UNICODE)
+
+def _canonical_query(query: str) -> str:
+    """Case, whitespace and punctuation-insensitive form of what Tavily would receive."""
+    q = (query or "").strip()[:400]
+    q = _CANON_APOS.sub("", q.lower())
+    return " ".join(_CANON_STRIP.sub(" ", q).split())
+
+def _query_key(query: str) -> str:
+    """_canonical_query plus the math tokens it strips, which change the question ("2*3" vs "2/3", "-5")."""
+    math_tokens = _signature(query)[0]
+    return _canonical_query(query) + ("|" + " ".join(math_tokens) if math_tokens else "")
+
+def answer_key(mode: str, text: str, *parts) -> str:
+    # Web answers share the search key; AI prompts only fold case and
+    # whitespace, since punctuation can change the question ("2*3" vs "2/3").
+    norm = _query_key(text) if mode == "web" else " ".join(text.lower().split())
+    digest = hashlib.sha1(norm.encode("utf-8")).hexdigest()
+    # Keyed by model too, so switching models never serves the old model's answers.
+    model = AI_MODEL if mode == "ai" else WEB_MODEL
+    return "|".join(["answer", mode, model, *map(str, parts), digest])
+
+# ---------- Semantic cache ----------
+# Paraphrase matching ("weather in paris today" ~ "paris weather today"): each
+# question is embedded on CPU as a signed, hashed bag of content words, their
+# character trigrams and (lightly weighted) ordered word pairs, and answers are
+# reused above a cosine threshold. Word order and arithmetic can change the
+# question without changing its words ("10 miles to km" vs "10 km to miles",
+# "2*3" vs "2/3"), so a hit also needs the same numbers and operators, in
+# order, and the same word pairs around relation words such as "to" or "than".
+_EMBED_DIM = 1024
+_STOPWORDS = frozenset(
+    "a an the in on at of for to is are was were be being been what whats how who "
+    "when where which do does did can could would should me my i you your it its "
+    "and or please tell about".split()
+)
+audit_log = app.logger.getChild("semantic_audit")  # route separately via its logger name
+
+def _fold_plural(w: str) -> str:
+    # Cheap plural folding; good enough for a cache key or a BM25 term.
+    return w[:-1] if len(w) > 3 and w.endswith("s") and not w.endswith("ss") else w
+
+def _content_words(text: str) -> List[str]:
+    return [_fold_plural(w) for w in _canonical_query(text).split() if w not in _STOPWORDS]
+
+# Numbers, and operators standing between numbers or spaces ("2*3", "5 - 1").
+_MATH_TOKEN = re.compile(r"\d+(?:[.,]\d+)?|(?:^|(?<=[\d\s()]))[-+*/^%=<>×÷](?=[\s\d(.])")
+_RELATION_WORDS = frozenset(
+    "to from into than vs versus over per before after minus plus times".split()
+)
+
+def _signature(text: str) -> tuple:
+    """What a paraphrase must keep exactly: math tokens in order, and (left, relation, right) triples."""
+    math_tokens = tuple(_MATH_TOKEN.findall((text or "").lower()))
+    words = _canonical_query(text).split()
+    relations = []
+    for i, w in enumerate(words):
+        if w not in _RELATION_WORDS:
+            continue
+        left = next((x for x in reversed(words[:i]) if x not in _STOPWORDS), None)
+        right = next((x for x in words[i + 1:] if x not in _STOPWORDS), None)
+        if left and right:
+            relations.append((_fold_plural(left), w, _fold_plural(right)))
+    return math_tokens, tuple(relations)
+
+def _embed(text: str):
+    v = np.zeros(_EMBED_DIM, dtype=np.float32)
+
+    def add(feature: str, weight: float) -> None:
+        h = zlib.crc32(feature.encode("utf-8"))
+        v[h % _EMBED_DIM] += weight if (h >> 16) & 1 else -weight
+
+    words = _content_words(text)
+    for w in words:
+        add(w, 1.0)
+        padded = f"<{w}>"
+        for i in range(len(padded) - 2):
+            add("#" + padded[i:i + 3], 0.3)
+    for a, b in zip(words, words[1:]):
+        add(f"{a}>{b}", 0.4)
+    for t in _signature(text)[0]:
+        add("=" + t, 1.0)
+    norm = float(np.linalg.norm(v))
+    return v / norm if norm else v
+
+class SemanticIndex:
+    """Fixed-capacity ring of (embedding, answer) pairs searched by cosine similarity."""
+
+    def __init__(self, name: str, capacity: int, threshold: float, ttl: float):
+        self.name = name
+        self.threshold = threshold
+        self.ttl = ttl
+        self.stats = {"hits": 0, "misses": 0, "rejected": 0, "inserts": 0}
+        self._vecs = np.zeros((capacity, _EMBED_DIM), dtype=np.float32)
+        self._expires = np.zeros(capacity, dtype=np.float64)
+        self._entries: List[Optional[tuple]] = [None] * capacity  # (question, answer)
+        self._next = 0
+        self._lock = threading.Lock()
+
+    def _best(self, v) -> Tuple[int, float]:
+        sims = self._vecs @ v
+        sims[self._expires <= time.time()] = -1.0
+        i = int(np.argmax(sims))
+        return i, float(sims[i])
+
+    def lookup(self, question: str) -> Optional[str]:
+        v = _embed(question)
+        if not v.any():
+            return None
+        with self._lock:
+            i, sim = self._best(v)
+            entry = self._entries[i]
+        if entry is None or sim < self.threshold:
+            count_stat(self.stats, "misses")
+            return None
+        if _signature(entry[0]) != _signature(question):
+            count_stat(self.stats, "misses")
+            count_stat(self.stats, "rejected")
+            return None
+        count_stat(self.stats, "hits")
+        audit_log.info(
+            "semantic hit index=%s sim=%.3f question=%r matched=%r",
+            self.name, sim, question[:200], entry[0][:200],
+        )
+        return entry[1]
+
+    def add(self, question: str, answer: str) -> None:
+        v = _embed(question)
+        if not v.any():
+            return
+        with self._lock:
+            i, sim = self._best(v)
+            same = sim >= 0.999 and _signature(self._entries[i][0]) == _signature(question)
+            if not same:  # otherwise refresh the identical question's slot in place
+                i = self._next
+                self._next = (self._next + 1) % len(self._entries)
+            self._vecs[i] = v
+            self._expires[i] = time.time() + self.ttl
+            self._entries[i] = (question, answer)
+        count_stat(self.stats, "inserts")
+
+_semantic_indexes: dict = {}
+_semantic_lock = threading.Lock()
+
+def _semantic(mode: str, *parts) -> Optional[SemanticIndex]:
+    """Per-worker index for mode (+ search parameters), or None when disabled."""
+    if not SEMANTIC_CACHE:
+        return None
+    name = "|".join([mode, *map(str, parts)])
+    with _semantic_lock:
+        index = _semantic_indexes.get(name)
+        if index is None:
+            if mode == "web":
+                threshold, ttl = SEMANTIC_THRESHOLD_WEB, WEB_ANSWER_SOFT_TTL_S
+            else:
+                threshold, ttl = SEMANTIC_THRESHOLD_AI, ANSWER_CACHE_TTL_S
+            index = _semantic_indexes[name] = SemanticIndex(name, SEMANTIC_CAPACITY, threshold, ttl)
+    return index
+
+def semantic_stats() -> dict:
+    with _semantic_lock:
+        return {name: dict(ix.stats) for name, ix in _semantic_indexes.items()}
+
+search_cache = TTLCache(SEARCH_CACHE_MAX_ENTRIES, SEARCH_CACHE_MAX_BYTES, SEARCH_CACHE_TTL_S)
+shared_cache = SharedCache(SHARED_CACHE_PATH, SHARED_CACHE_MAX_BYTES, SHARED_CACHE_COMPACT_S)
+search_flight = SingleFlight()
+llm_flight = SingleFlight()
 
 # ---------- Tavily search ----------
-def tavily_search(query: str, k: int = 5, depth: str = "basic") -> List[SearchItem]:
+def tavily_search(query: str, k: int = 5, depth: str = "basic",
+                  use_cache: bool = True, timeout: float = SEARCH_TIMEOUT_S) -> List[SearchItem]:
     """
     depth: 'basic' (1 credit) or 'advanced' (2 credits).
+    use_cache=False skips the cache lookup; the fresh result is still stored.
     """
+    key = search_key(query, k, depth)
+    if use_cache:
+        cached = cached_search(key)
+        if cached is not None:
+            return cached
+
+    def fetch() -> List[SearchItem]:
+        headers, payload = tavily_request(query, k, depth)
+        data = _tavily_post(headers, payload, timeout)
+        items = parse_results(data, k)
+        store_search(key, items)
+        return items
+
+    return [dict(it) for it in search_flight.do(key, fetch, timeout=timeout)]
+
+TAVILY_CREDITS = {"basic": 1, "advanced": 2}
+
+def search_key(query: str, k: int, depth: str) -> str:
+    return f"{depth}|{k}|{_query_key(query)}"
+
+def cached_search(key: str) -> Optional[List[SearchItem]]:
+    cached = search_cache.get(key)
+    if cached is None:
+        cached = shared_cache.get("search|" + key)
+        if cached is not None:
+            search_cache.set(key, cached, len(json.dumps(cached)))
+    return [dict(it) for it in cached] if cached is not None else None
+
+def store_search(key: str, items: List[SearchItem]) -> None:
+    search_cache.set(key, items, len(json.dumps(items)))
+    shared_cache.set("search|" + key, items, SEARCH_CACHE_TTL_S)
+
+def tavily_request(query: str, k: int, depth: str) -> Tuple[dict, dict]:
+    """Headers and JSON body for a Tavily search."""
     api_key = os.getenv("TAVILY_API_KEY", "")
     if not api_key:
         raise RuntimeError("TAVILY_API_KEY not set")
@@ -56,79 +1048,1153 @@ def tavily_search(query: str, k: int = 5, depth: str = "basic") -> List[SearchIt
         "Content-Type": "application/json",
         "Authorization": f"Bearer {api_key}",
     }
-    data = _post_json("https://api.tavily.com/search", headers, payload)
+    return headers, payload
 
+def parse_results(data: dict, k: int) -> List[SearchItem]:
     items: List[SearchItem] = []
     for r in data.get("results", [])[:k]:
         items.append({
             "title": (r.get("title") or "").strip(),
             "url": r.get("url") or "",
-            "snippet": (r.get("content") or "").strip()[:500],
+            "snippet": (r.get("content") or "").strip()[:SNIPPET_MAX_CHARS],
+            "score": float(r.get("score") or 0.0),
         })
     return items
 
+# ---------- Retries and hedging ----------
+# A Tavily search is retried on timeouts, connection errors, 429 and 5xx with
+# full-jitter exponential backoff, as long as the search's time budget allows
+# another attempt. Each attempt gets an even share of what is left for it and
+# the retries still possible (but never less than the observed p99 latency),
+# so a hung request times out early enough to be retried. With TAVILY_HEDGE on, an attempt still running after the
+# worker's observed p95 Tavily latency gets an identical second request and
+# the first good response wins; a hedge costs another search's credits.
+RETRY_STATS = {"attempts": 0, "retries": 0, "gave_up": 0, "hedged": 0, "hedge_wins": 0}
+RETRY_MIN_S = 0.5     # below this much time left, do not start another attempt
+HEDGE_MIN_SAMPLES = 20
+_tavily_latencies: deque = deque(maxlen=200)  # seconds, successful attempts
+_hedge_pool = ThreadPoolExecutor(max_workers=TAVILY_POOL_SIZE, thread_name_prefix="tavily-hedge")
+
+def retryable(exc: BaseException) -> bool:
+    if isinstance(exc, (TIMEOUT_ERRORS, _CONNECTION_ERRORS)):
+        return True
+    status = _status_label(exc)
+    return status == "429" or status.startswith("5")
+
+def _retry_after(exc: BaseException) -> Optional[float]:
+    """Seconds asked for by the response's Retry-After header (delay or HTTP date), if any."""
+    headers = getattr(getattr(exc, "response", None), "headers", None) or {}
+    value = (headers.get("Retry-After") or "").strip()
+    if value.isdigit():
+        return float(value)
+    try:
+        return max(0.0, parsedate_to_datetime(value).timestamp() - time.time())
+    except (TypeError, ValueError, OverflowError):
+        return None
+
+def backoff_delay(attempt: int, exc: BaseException) -> float:
+    """Seconds to wait before retry number attempt+1: Retry-After if given, else full jitter."""
+    retry_after = _retry_after(exc)
+    if retry_after is not None:
+        return retry_after
+    return random.uniform(0.0, min(TAVILY_BACKOFF_MAX_S, TAVILY_BACKOFF_S * 2 ** attempt))
+
+def retry_pause(attempt: int, exc: BaseException, end: float) -> Optional[float]:
+    """Seconds to sleep before retrying after exc, or None to give up.
+
+    A server asking for a longer wait than TAVILY_BACKOFF_MAX_S, or than is
+    left of the budget ending at end, is not retried early.
+    """
+    pause = backoff_delay(attempt, exc)
+    if (attempt >= TAVILY_RETRIES or pause > TAVILY_BACKOFF_MAX_S
+            or time.monotonic() + pause + RETRY_MIN_S > end):
+        count_stat(RETRY_STATS, "gave_up")
+        return None
+    app.logger.info("Tavily attempt %d failed (%s), retrying in %.2fs", attempt + 1, exc, pause)
+    count_stat(RETRY_STATS, "retries")
+    return pause
+
+def record_tavily_latency(seconds: float) -> None:
+    with _stats_lock:
+        _tavily_latencies.append(seconds)
+
+def _tavily_latency(q: float, min_samples: int = 1) -> Optional[float]:
+    """Quantile q of recent successful attempt latencies, or None with fewer than min_samples."""
+    with _stats_lock:
+        samples = sorted(_tavily_latencies)
+    if len(samples) < max(1, min_samples):
+        return None
+    return samples[int(q * (len(samples) - 1))]
+
+def hedge_delay(timeout: float) -> Optional[float]:
+    """When to send the hedge: the observed p95 latency, or None (no hedging within timeout)."""
+    if not TAVILY_HEDGE:
+        return None
+    p95 = _tavily_latency(0.95, HEDGE_MIN_SAMPLES)
+    if p95 is None:
+        return None
+    delay = max(TAVILY_HEDGE_MIN_S, p95)
+    return delay if delay + RETRY_MIN_S <= timeout else None
+
+def attempt_timeout(attempt: int, end: float) -> float:
+    """Timeout for attempt number attempt+1 of a search that must finish by end."""
+    left = max(0.0, end - time.monotonic())
+    share = left / (max(0, TAVILY_RETRIES - attempt) + 1)
+    p99 = _tavily_latency(0.99, HEDGE_MIN_SAMPLES)
+    return min(left, max(share, p99 or 0.0))
+
+# The bookkeeping around one Tavily request, shared with asgi.py, which only
+# sends the request differently.
+def attempt_started(timeout: float) -> float:
+    if timeout <= 0:  # requests rejects a zero timeout with ValueError
+        raise TimeoutError("Tavily search timed out")
+    count_stat(RETRY_STATS, "attempts")
+    return time.perf_counter()
+
+def attempt_succeeded(payload: dict, t0: float) -> None:
+    record_tavily_latency(time.perf_counter() - t0)
+    depth = payload["search_depth"]
+    metrics.inc("boog_tavily_credits_total", TAVILY_CREDITS.get(depth, 1), depth=depth)
+
+def _tavily_attempt(headers: dict, payload: dict, timeout: float) -> dict:
+    t0 = attempt_started(timeout)
+    with tavily_breaker.call(timeout), upstream_call("tavily"):
+        data = _post_json(TAVILY_URL, headers, payload, timeout=timeout)
+    attempt_succeeded(payload, t0)
+    return data
+
+def _tavily_hedged(headers: dict, payload: dict, timeout: float) -> dict:
+    delay = hedge_delay(timeout)
+    if delay is None:
+        return _tavily_attempt(headers, payload, timeout)
+    end = time.monotonic() + timeout
+    first = _hedge_pool.submit(_tavily_attempt, headers, payload, timeout)
+    if wait([first], timeout=delay).done:
+        return first.result()
+    count_stat(RETRY_STATS, "hedged")
+    # The slower request cannot be aborted from here; it finishes in the background.
+    hedge = _hedge_pool.submit(_tavily_attempt, headers, payload, max(0.0, end - time.monotonic()))
+    pending, error = {first, hedge}, None
+    while pending:
+        done, pending = wait(pending, timeout=max(0.0, end - time.monotonic()), return_when=FIRST_COMPLETED)
+        if not done:
+            raise TimeoutError("Tavily search timed out")
+        for f in done:
+            if f.exception() is None:
+                if f is hedge:
+                    count_stat(RETRY_STATS, "hedge_wins")
+                return f.result()
+            error = f.exception()
+    raise error
+
+def _tavily_post(headers: dict, payload: dict, timeout: float) -> dict:
+    end = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        try:
+            return _tavily_hedged(headers, payload, attempt_timeout(attempt, end))
+        except Exception as exc:
+            if not retryable(exc):
+                raise
+            pause = retry_pause(attempt, exc, end)
+            if pause is None:
+                raise
+        time.sleep(pause)
+        attempt += 1
+
+def retry_stats() -> dict:
+    with _stats_lock:
+        stats = dict(RETRY_STATS)
+    p95 = _tavily_latency(0.95)
+    stats["latency_p95_s"] = round(p95, 4) if p95 is not None else None
+    return stats
+
+# ---------- Circuit breakers ----------
+# During an outage every request would otherwise wait out its full timeout and
+# tie up a worker. Each upstream gets a breaker: once BREAKER_FAILURE_RATE of
+# the calls in the last BREAKER_WINDOW_S failed (timeouts, connection errors,
+# 429, 5xx, or slower than BREAKER_SLOW_S), calls are rejected at once for
+# BREAKER_OPEN_S; then a single probe call decides whether it closes again.
+# Web mode then answers without sources, and a Groq outage leaves the sources.
+class CircuitOpenError(Exception):
+    """Raised instead of calling an upstream whose breaker is open."""
+
+# Upstream failures answered with a degraded reply (no sources, or a message)
+# rather than an error.
+_DEGRADE_ERRORS = TIMEOUT_ERRORS + (CircuitOpenError,)
+
+class CircuitBreaker:
+    def __init__(self, name: str):
+        self.name = name
+        self.state = "closed"  # closed -> open -> half_open -> closed | open
+        self.stats = {"opened": 0, "rejected": 0, "probes": 0, "closed": 0}
+        self._outcomes: deque = deque()  # (monotonic time, failed)
+        self._opened_at = 0.0
+        self._probing = False
+        self._lock = threading.Lock()
+
+    def allow(self) -> bool:
+        """Raise CircuitOpenError, or let the call through; True when it is the half-open probe."""
+        if not BREAKER:
+            return False
+        with self._lock:
+            if self.state == "closed":
+                return False
+            if self.state == "open" and time.monotonic() - self._opened_at >= BREAKER_OPEN_S:
+                self.state = "half_open"
+            if self.state == "half_open" and not self._probing:
+                self._probing = True
+                self.stats["probes"] += 1
+                return True
+            self.stats["rejected"] += 1
+        raise CircuitOpenError(f"{self.name} is unavailable (circuit open)")
+
+    def record(self, failed: bool, probe: bool = False) -> None:
+        if not BREAKER:
+            return
+        now = time.monotonic()
+        with self._lock:
+            if probe:
+                self._probing = False
+                if failed:
+                    self._open(now)
+                else:
+                    self.state = "closed"
+                    self.stats["closed"] += 1
+                    app.logger.warning("%s circuit closed", self.name)
+                return
+            if self.state != "closed":
+                return  # a call that started before the breaker opened
+            self._outcomes.append((now, failed))
+            while self._outcomes[0][0] < now - BREAKER_WINDOW_S:
+                self._outcomes.popleft()
+            failures = sum(f for _, f in self._outcomes)
+            if len(self._outcomes) >= BREAKER_MIN_CALLS and failures >= BREAKER_FAILURE_RATE * len(self._outcomes):
+                self._open(now)
+
+    def _open(self, now: float) -> None:
+        self.state = "open"
+        self._opened_at = now
+        self._outcomes.clear()
+        self.stats["opened"] += 1
+        app.logger.warning("%s circuit opened for %.0fs", self.name, BREAKER_OPEN_S)
+
+    @contextmanager
+    def call(self, timeout: float):
+        """
+        Guard one upstream call made with the given timeout. A 4xx still counts
+        as a success (the upstream answered). Timing out within less than
+        BREAKER_MIN_VERDICT_S says more about the request's deadline (which
+        clients choose) than about the upstream, so it gives no verdict.
+        """
+        probe = self.allow()
+        t0 = time.monotonic()
+        try:
+            yield
+        except Exception as exc:
+            if isinstance(exc, TIMEOUT_ERRORS) and timeout < BREAKER_MIN_VERDICT_S:
+                self._no_verdict(probe)
+            else:
+                self.record(retryable(exc), probe)
+            raise
+        except BaseException:  # cancelled: no verdict either
+            self._no_verdict(probe)
+            raise
+        self.record(time.monotonic() - t0 > BREAKER_SLOW_S, probe)
+
+    def _no_verdict(self, probe: bool) -> None:
+        if probe:  # let another call probe instead
+            with self._lock:
+                self._probing = False
+
+    def snapshot(self) -> dict:
+        with self._lock:
+            return dict(self.stats, state=self.state)
+
+tavily_breaker = CircuitBreaker("tavily")
+groq_breaker = CircuitBreaker("groq")
+
+# ---------- Adaptive depth ----------
+# depth="auto" searches "basic" (1 credit) first and escalates to "advanced"
+# (2 credits) only when the basic results look weak. ESCALATE_RACE starts both
+# at once instead: no added latency on escalation, but every search pays 3
+# credits (a losing advanced search still completes and fills the cache).
+ESCALATION_STATS = {"searches": 0, "escalated": 0, "advanced_failed": 0, "skipped_no_time": 0}
+ESCALATE_MIN_S = 1.0  # below this much time left, keep the basic results
+_escalation_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="search-escalate")
+
+def search_quality(query: str, results: List[SearchItem], k: int) -> float:
+    """0..1 from result count, Tavily scores and how many query terms the results cover."""
+    if not results:
+        return 0.0
+    count = min(1.0, len(results) / max(1, k))
+    top = sorted((r.get("score", 0.0) for r in results), reverse=True)[:3]
+    score = sum(top) / len(top)
+    terms = set(_terms(query))
+    text = set(_terms(" ".join(f"{r['title']} {r['snippet']}" for r in results)))
+    coverage = len(terms & text) / len(terms) if terms else 1.0
+    return 0.3 * count + 0.3 * score + 0.4 * coverage
+
+def should_escalate(query: str, basic: List[SearchItem], k: int, left: float, racing: bool) -> bool:
+    """Whether the basic results are weak enough, and time is left, for the advanced ones."""
+    if search_quality(query, basic, k) >= ESCALATE_BELOW:
+        return False
+    if not racing and left < ESCALATE_MIN_S:
+        count_stat(ESCALATION_STATS, "skipped_no_time")
+        return False
+    count_stat(ESCALATION_STATS, "escalated")
+    return True
+
+def escalation_failed(exc: BaseException) -> None:
+    count_stat(ESCALATION_STATS, "advanced_failed")
+    app.logger.warning("Advanced search failed, keeping basic results: %s", exc)
+
+def _search_one(query: str, k: int, depth: str, use_cache: bool, timeout: float) -> List[SearchItem]:
+    if depth != "auto":
+        return tavily_search(query, k=k, depth=depth, use_cache=use_cache, timeout=timeout)
+    t0 = time.monotonic()
+    count_stat(ESCALATION_STATS, "searches")
+    advanced = None
+    if ESCALATE_RACE:
+        advanced = _escalation_pool.submit(tavily_search, query, k, "advanced", use_cache, timeout)
+    basic = tavily_search(query, k=k, depth="basic", use_cache=use_cache, timeout=timeout)
+    left = timeout - (time.monotonic() - t0)
+    if not should_escalate(query, basic, k, left, racing=advanced is not None):
+        if advanced is not None:
+            advanced.cancel()  # only stops it if it has not started
+        return basic
+    try:
+        with stage("escalation"):
+            if advanced is None:
+                better = tavily_search(query, k=k, depth="advanced", use_cache=use_cache, timeout=left)
+            else:
+                better = advanced.result(timeout=max(0.0, left))
+    except Exception as exc:  # the basic results are still an answer
+        escalation_failed(exc)
+        return basic
+    return better if better else basic
+
+def escalation_stats() -> dict:
+    with _stats_lock:
+        stats = dict(ESCALATION_STATS)
+    stats["escalation_rate"] = round(stats["escalated"] / stats["searches"], 4) if stats["searches"] else None
+    return stats
+
+# ---------- Fan-out ----------
+# With FANOUT on, compound questions ("A vs B", "difference between A and B",
+# several questions in one message) are also searched as sub-queries, all at
+# once, so the wall time is that of the slowest search rather than the sum.
+# The union is deduplicated and re-ranked against the original question.
+FANOUT_STATS = {"fanouts": 0, "subqueries": 0, "failed": 0}
+_fanout_pool = ThreadPoolExecutor(max_workers=FANOUT_WORKERS, thread_name_prefix="search-fanout")
+_FANOUT_SPLIT = re.compile(r"\?\s+|;\s*|\n+")
+_FANOUT_VERSUS = re.compile(r"\s+(?:vs\.?|versus|compared (?:to|with))\s+", re.I)
+_FANOUT_BETWEEN = re.compile(
+    r"^(?:what(?:'s| is| are) the )?(?:differences? between|compare)\s+(.+?)\s+(?:and|with|to)\s+(.+)$", re.I)
+
+def decompose(query: str) -> List[str]:
+    """The query itself, then up to FANOUT_MAX_QUERIES - 1 rule-based sub-queries."""
+    query = " ".join(query.split())
+    subs = [query]
+    for part in _FANOUT_SPLIT.split(query):
+        part = part.strip(" ?.!")
+        m = _FANOUT_BETWEEN.match(part)
+        sides = list(m.groups()) if m else _FANOUT_VERSUS.split(part)
+        subs += sides if len(sides) > 1 else [part]
+    out, seen = [], set()
+    for sub in subs:
+        key = _query_key(sub)
+        if key and key not in seen:
+            seen.add(key)
+            out.append(sub)
+    return out[:max(1, FANOUT_MAX_QUERIES)]
+
+def fanout_queries(query: str) -> List[str]:
+    """The queries to search for query: itself alone unless FANOUT splits it."""
+    subs = decompose(query) if FANOUT else [query]
+    if len(subs) > 1:
+        count_stat(FANOUT_STATS, "fanouts")
+        count_stat(FANOUT_STATS, "subqueries", len(subs))
+    return subs
+
+def merge_fanout(subs: List[str], outcomes: List[Union[List[SearchItem], BaseException]]) -> List[SearchItem]:
+    """The sub-queries' results in sub-query order (the original query's first); errors only if all failed."""
+    merged: List[SearchItem] = []
+    errors: List[BaseException] = []
+    for outcome in outcomes:
+        if isinstance(outcome, BaseException):
+            errors.append(outcome)
+        else:
+            merged.extend(outcome)
+    if errors:
+        count_stat(FANOUT_STATS, "failed", len(errors))
+        if not merged:
+            raise errors[0]
+        app.logger.warning("%d of %d fan-out searches failed: %s", len(errors), len(subs), errors[0])
+    return merged
+
+def web_search(query: str, k: int, depth: str, use_cache: bool, timeout: float) -> List[SearchItem]:
+    """Candidate results for query: one Tavily search, or the merged fan-out."""
+    subs = fanout_queries(query)
+    if len(subs) == 1:
+        return _search_one(query, fetch_k(k), depth, use_cache, timeout)
+    futures = [_fanout_pool.submit(_search_one, q, fetch_k(k), depth, use_cache, timeout) for q in subs]
+    done, _ = wait(futures, timeout=timeout)
+    return merge_fanout(subs, [
+        (f.exception() or f.result()) if f in done else TimeoutError("fan-out search timed out")
+        for f in futures
+    ])
+
+# ---------- Deduplication ----------
+# The same article often comes back as AMP, mobile and tracking-parameter
+# variants, or as syndicated copies: results are dropped when their canonical
+# URL was already seen or their snippet's SimHash is within a few bits of one.
+DEDUP_STATS = {"searches": 0, "url_duplicates": 0, "near_duplicates": 0}
+# Only keys that never select content: generic ones such as ref (GitHub's
+# branch), src or share can, so they are kept.
+_TRACKING_PARAMS = frozenset(
+    "fbclid gclid dclid msclkid yclid twclid ttclid igshid li_fat_id mc_cid mc_eid _ga _gl "
+    "ref_src ref_url cmpid spm amp outputtype".split()
+)
+_HOST_PREFIXES = ("www.", "m.", "mobile.", "amp.")
+
+def canonical_url(url: str) -> str:
+    try:
+        parts = urlsplit(url.strip())
+        port = parts.port
+    except ValueError:
+        return url
+    host = (parts.hostname or "").lower()
+    for prefix in _HOST_PREFIXES:
+        if host.startswith(prefix):
+            host = host[len(prefix):]
+            break
+    if port is not None and port not in (80, 443):  # http and https are folded, not other ports
+        host = f"{host}:{port}"
+    path = parts.path.rstrip("/")
+    if path.endswith(("/amp", ".amp")):
+        path = path[:-4]
+    if path.startswith("/amp/"):
+        path = path[4:]
+    path = path.replace(".amp.htm", ".htm")
+    query = sorted((k, v) for k, v in parse_qsl(parts.query, keep_blank_values=True)
+                   if not k.lower().startswith("utm_") and k.lower() not in _TRACKING_PARAMS)
+    return urlunsplit(("https", host, path, urlencode(query), ""))
+
+def _simhash(text: str) -> int:
+    """64-bit SimHash over content words (robust to the reordering and trimming of short snippets)."""
+    weights = [0] * 64
+    for w in _terms(text):
+        h = int.from_bytes(hashlib.blake2b(w.encode("utf-8"), digest_size=8).digest(), "big")
+        for bit in range(64):
+            weights[bit] += 1 if (h >> bit) & 1 else -1
+    return sum(1 << bit for bit in range(64) if weights[bit] > 0)
+
+def dedup(results: List[SearchItem]) -> List[SearchItem]:
+    """Results minus URL variants and near-duplicate snippets, first occurrence kept."""
+    if not DEDUP:
+        return results
+    kept: List[SearchItem] = []
+    urls, hashes = set(), []
+    removed = {"url_duplicates": 0, "near_duplicates": 0}
+    for r in results:
+        url = canonical_url(r["url"])
+        if url in urls:
+            removed["url_duplicates"] += 1
+            continue
+        # Very short snippets collide by chance; only compare substantial ones.
+        h = _simhash(r["snippet"]) if len(r["snippet"].split()) >= 8 else None
+        if h is not None and any(bin(h ^ o).count("1") <= DEDUP_SIMHASH_DISTANCE for o in hashes):
+            removed["near_duplicates"] += 1
+            continue
+        urls.add(url)
+        if h is not None:
+            hashes.append(h)
+        kept.append(r)
+    count_stat(DEDUP_STATS, "searches")
+    for key, n in removed.items():
+        if n:
+            count_stat(DEDUP_STATS, key, n)
+    note_timing("dedup_removed", sum(removed.values()))
+    return kept
+
+# ---------- Re-ranking ----------
+# Tavily is asked for RERANK_FETCH_K results; BM25 over title + snippet (blended
+# with Tavily's own score) picks the relevant ones and maximal marginal
+# relevance skips near-duplicates, so Groq gets k diverse sources.
+RERANK_STATS = {"reranked": 0, "redundant_dropped": 0}
+_TERM = re.compile(r"[a-z0-9+#]+")
+
+def _terms(text: str) -> List[str]:
+    return [_fold_plural(w) for w in _TERM.findall(text.lower()) if w not in _STOPWORDS]
+
+def _bm25(query: List[str], docs: List[List[str]], k1: float = 1.2, b: float = 0.75) -> List[float]:
+    n = len(docs)
+    avgdl = sum(map(len, docs)) / n or 1.0
+    df = Counter(t for d in docs for t in set(d))
+    scores = []
+    for d in docs:
+        tf = Counter(d)
+        score = 0.0
+        for t in set(query):
+            if t in tf:
+                idf = math.log(1 + (n - df[t] + 0.5) / (df[t] + 0.5))
+                score += idf * tf[t] * (k1 + 1) / (tf[t] + k1 * (1 - b + b * len(d) / avgdl))
+        scores.append(score)
+    return scores
+
+def _jaccard(a: set, b: set) -> float:
+    return len(a & b) / len(a | b) if a and b else 0.0
+
+def fetch_k(k: int) -> int:
+    """How many results to ask Tavily for when k will be sent to Groq."""
+    return max(k, RERANK_FETCH_K) if RERANK else k
+
+def select_sources(query: str, results: List[SearchItem], k: int) -> List[SearchItem]:
+    """The k results worth sending to Groq: deduplicated, then re-ranked."""
+    with stage("dedup"):
+        results = dedup(results)
+    with stage("rerank"):
+        return rerank(query, results, k)
+
+def rerank(query: str, results: List[SearchItem], k: int) -> List[SearchItem]:
+    """Up to k results by MMR over BM25 relevance; "score" becomes that relevance."""
+    if not RERANK or len(results) <= 1:
+        return results[:k]
+    docs = [_terms(f"{r['title']} {r['snippet']}") for r in results]
+    bm25 = _bm25(_terms(query), docs)
+    top = max(bm25) or 1.0
+    rel = [(s / top + r.get("score", 0.0)) / 2 for s, r in zip(bm25, results)]
+    sets = [set(d) for d in docs]
+
+    def redundancy(i: int) -> float:
+        return max((_jaccard(sets[i], sets[j]) for j in chosen), default=0.0)
+
+    chosen: List[int] = []
+    candidates = list(range(len(results)))
+    while candidates and len(chosen) < k:
+        best = max(candidates, key=lambda i: RERANK_MMR_LAMBDA * rel[i] - (1 - RERANK_MMR_LAMBDA) * redundancy(i))
+        candidates.remove(best)
+        if redundancy(best) >= RERANK_DUP_SIMILARITY:
+            count_stat(RERANK_STATS, "redundant_dropped")
+            continue
+        chosen.append(best)
+    count_stat(RERANK_STATS, "reranked")
+    return [{**results[i], "score": round(rel[i], 4)} for i in chosen]
+
+# ---------- Prompt budget ----------
+# Prefill time grows with prompt length, so web-search sources are packed by
+# relevance into PROMPT_TOKEN_BUDGET tokens instead of being pasted whole.
+PROMPT_STATS = {"built": 0, "sources_dropped": 0, "snippets_trimmed": 0}
+MIN_SNIPPET_TOKENS = 40
+_SENTENCE_END = re.compile(r"(?<=[.!?])\s+")
+_encoding = None
+
+def load_encoder() -> None:
+    """
+    Load the PROMPT_TOKENIZER encoding. tiktoken downloads its BPE file on
+    first use, so this runs from warm_up, outside any request's deadline;
+    until it finishes, tokens are estimated.
+    """
+    global _encoding
+    if _encoding is not None or not _HAVE_TIKTOKEN:
+        return
+    try:
+        _encoding = tiktoken.get_encoding(PROMPT_TOKENIZER)
+    except Exception as exc:  # unknown name, or its BPE file cannot be fetched
+        _encoding = False
+        app.logger.warning("Tokenizer %s unavailable (%s); estimating tokens", PROMPT_TOKENIZER, exc)
+
+def _encoder():
+    return _encoding or None
+
+def count_tokens(text: str) -> int:
+    enc = _encoder()
+    if enc is not None:
+        return len(enc.encode(text, disallowed_special=()))
+    # About 4 characters per token in English prose; never fewer than the words.
+    return max((len(text) + 3) // 4, len(text.split()))
+
+def _trim_to_tokens(text: str, budget: int) -> str:
+    """Longest prefix of whole sentences within budget; a word cut only if one sentence is too long."""
+    if count_tokens(text) <= budget:
+        return text
+    out = ""
+    for sentence in _SENTENCE_END.split(text):
+        candidate = f"{out} {sentence}" if out else sentence
+        if count_tokens(candidate) > budget:
+            break
+        out = candidate
+    if not out:
+        words = text.split()
+        keep = max(1, len(words) * (budget - 1) // count_tokens(text))
+        out = " ".join(words[:keep]) + " …"
+    return out
+
+def _source_header(i: int, r: SearchItem) -> str:
+    return f"[{i}] {r['title'] or r['url']}\nURL: {r['url']}\nSnippet: "
+
+def pack_sources(results: List[SearchItem], budget: int = PROMPT_TOKEN_BUDGET) -> List[SearchItem]:
+    """Most relevant sources first, trimmed at sentence boundaries to fit budget tokens."""
+    # sorted() is stable: equal scores (e.g. cached results without one) keep Tavily's order.
+    ranked = sorted(results, key=lambda r: r.get("score", 0.0), reverse=True)
+    packed: List[SearchItem] = []
+    left = budget
+    for r in ranked:
+        room = left - count_tokens(_source_header(len(packed) + 1, r))
+        if packed and room < MIN_SNIPPET_TOKENS:
+            break
+        snippet = _trim_to_tokens(r["snippet"], max(room, MIN_SNIPPET_TOKENS))
+        if snippet != r["snippet"]:
+            count_stat(PROMPT_STATS, "snippets_trimmed")
+        packed.append({**r, "snippet": snippet})
+        left = room - count_tokens(snippet)
+    count_stat(PROMPT_STATS, "sources_dropped", len(results) - len(packed))
+    return packed
+
 # ---------- Groq LLM ----------
+NO_GROQ_MSG = "GROQ_API_KEY is not set on the server – AI mode is unavailable."
+
+# One client per worker process, created lazily after gunicorn forks so that
+# pooled connections are never shared across processes.
+GROQ_STATS = {"clients": 0, "requests": 0, "connections": 0}
+_groq_lock = threading.Lock()
+_groq_client: Optional[Groq] = None
+_groq_pid = 0
+
+def _trace_groq(event: str, info: dict) -> None:
+    if event == "connection.connect_tcp.complete":
+        count_stat(GROQ_STATS, "connections")
+
+def _on_groq_request(req: httpx.Request) -> None:
+    count_stat(GROQ_STATS, "requests")
+    req.extensions["trace"] = _trace_groq
+
 def _groq() -> Optional[Groq]:
+    global _groq_client, _groq_pid
     key = os.getenv("GROQ_API_KEY", "")
-    return Groq(api_key=key) if key else None
+    if not key:
+        return None
+    pid = os.getpid()
+    if _groq_client is not None and _groq_pid == pid:
+        return _groq_client
+    with _groq_lock:
+        if _groq_client is None or _groq_pid != pid:
+            http2 = GROQ_HTTP2 and HAVE_H2
+            if GROQ_HTTP2 and not HAVE_H2:
+                app.logger.warning("GROQ_HTTP2 is set but 'h2' is not installed; using HTTP/1.1")
+            http_client = DefaultHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=GROQ_POOL_SIZE,
+                    max_keepalive_connections=GROQ_POOL_SIZE,
+                    keepalive_expiry=GROQ_KEEPALIVE_S,
+                ),
+                http2=http2,
+                event_hooks={"request": [_on_groq_request]},
+            )
+            # A client inherited from the parent is dropped, not closed: its
+            # sockets still belong to the parent process.
+            _groq_client = Groq(api_key=key, base_url=GROQ_BASE_URL, http_client=http_client)
+            _groq_pid = pid
+            count_stat(GROQ_STATS, "clients")
+    return _groq_client
 
-def generate_ai_response(prompt: str) -> str:  # unchanged pure-LLM path
-    client = _groq()
-    if not client:
-        return "GROQ_API_KEY is not set on the server – AI mode is unavailable."
-    r = client.chat.completions.create(
-        model="openai/gpt-oss-120b",
-        messages=[
-            {"role": "system", "content": "You are Boog – concise, helpful."},
-            {"role": "user", "content": prompt},
-        ],
-        temperature=0.6,
-    )
-    return (r.choices[0].message.content or "").strip() or "(No response)"
+def groq_pool_stats() -> dict:
+    with _stats_lock:
+        stats = dict(GROQ_STATS)
+    reqs = stats["requests"]
+    stats["reuse_rate"] = round(1 - stats["connections"] / reqs, 4) if reqs else None
+    return stats
 
-def answer_with_web_search(query: str, k: int = 5, depth: str = "basic") -> str:
-    try:
-        results = tavily_search(query, k=k, depth=depth)
-    except Exception as exc:
-        app.logger.error("Tavily error: %s", exc)
-        return "Web search is temporarily unavailable."
+def ai_messages(prompt: str) -> List[dict]:
+    return [
+        {"role": "system", "content": "You are Boog – concise, helpful."},
+        {"role": "user", "content": prompt},
+    ]
 
-    if not results:
-        return "No results found."
-
-    # Build grounded prompt
-    sources_txt = []
-    for i, r in enumerate(results, 1):
-        title = r["title"] or r["url"]
-        sources_txt.append(
-            f"[{i}] {title}\nURL: {r['url']}\nSnippet: {r['snippet']}"
-        )
+def _web_messages(query: str, results: List[SearchItem]) -> Tuple[List[dict], List[SearchItem]]:
+    """Grounded prompt plus the sources it cites, numbered as in the prompt."""
+    results = pack_sources(results)
+    sources_txt = [_source_header(i, r) + r["snippet"] for i, r in enumerate(results, 1)]
     prompt = (
         "Use the numbered sources to answer. Cite like [1], [2]. "
         "Only include supported claims; if unclear, say so.\n\n"
         f"USER QUESTION:\n{query}\n\nSOURCES:\n" + "\n\n".join(sources_txt)
     )
+    messages = [
+        {"role": "system", "content": "Ground answers in the sources and cite."},
+        {"role": "user", "content": prompt},
+    ]
+    tokens = sum(count_tokens(m["content"]) for m in messages)
+    count_stat(PROMPT_STATS, "built")
+    metrics.observe("boog_prompt_tokens", tokens)
+    note_timing("prompt_tokens", tokens)
+    return messages, results
 
-    client = _groq()
-    if not client:
-        return "GROQ_API_KEY is not set on the server – AI mode is unavailable."
-
-    r = client.chat.completions.create(
-        model="openai/gpt-oss-120b",
-        messages=[
-            {"role": "system", "content": "Ground answers in the sources and cite."},
-            {"role": "user", "content": prompt},
-        ],
-        temperature=0.3,
-    )
-    answer = (r.choices[0].message.content or "").strip()
+def sources_event(results: List[SearchItem]) -> dict:
+    """The {"sources": [...]} stream event: the numbered sources, sent before the answer."""
+    return {"sources": [
+        {"n": i, "title": r["title"] or r["url"], "url": r["url"],
+         "host": urlsplit(r["url"]).hostname or "", "snippet": r["snippet"][:200]}
+        for i, r in enumerate(results, 1)
+    ]}
 
+def sources_footer(results: List[SearchItem]) -> str:
     links = "\n".join(
         f"- [{i}] {it['title'] or it['url']} — {it['url']}"
         for i, it in enumerate(results, 1)
     )
-    return f"{answer}\n\n---\n**Sources (links):**\n{links}"
+    return f"\n\n---\n**Sources (links):**\n{links}"
+
+def _llm(client: Groq, deadline: Deadline) -> Groq:
+    # The deadline bounds the whole call, so SDK retries are not allowed to
+    # stretch it.
+    return client.with_options(timeout=deadline.remaining(), max_retries=0)
+
+def _complete(client: Groq, model: str, messages: List[dict], temperature: float,
+              deadline: Deadline) -> str:
+    with stage("llm"), groq_breaker.call(deadline.remaining()), upstream_call("groq"):
+        r = _llm(client, deadline).chat.completions.create(
+            model=model, messages=messages, temperature=temperature,
+        )
+    record_usage(r.usage)
+    return (r.choices[0].message.content or "").strip()
+
+def chunk_usage(chunk):
+    # Groq reports usage on the last chunk under x_groq; OpenAI-style under usage.
+    x_groq = getattr(chunk, "x_groq", None)
+    return getattr(x_groq, "usage", None) or getattr(chunk, "usage", None)
+
+def _stream_completion(client: Groq, model: str, messages: List[dict], temperature: float,
+                       deadline: Deadline) -> Iterator[str]:
+    """Yield content deltas from a Groq completion as they arrive, until the deadline."""
+    started = False
+    streamed = 0
+    t0 = time.perf_counter()
+    try:
+        with stage("llm"), upstream_call("groq"):
+            with groq_breaker.call(deadline.remaining()):  # judged on how fast the stream starts
+                stream = _llm(client, deadline).chat.completions.create(
+                    model=model, messages=messages, temperature=temperature, stream=True,
+                )
+            try:
+                for chunk in stream:
+                    record_usage(chunk_usage(chunk))
+                    if deadline.expired():
+                        yield TRUNCATED_MSG
+                        return
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not started:
+                            started = True
+                            metrics.observe("boog_stage_seconds", time.perf_counter() - t0,
+                                            stage="llm_first_token")
+                        streamed += 1
+                        yield delta
+            finally:
+                stream.close()
+    except GeneratorExit:
+        record_cancelled_stream(streamed)
+        raise
+    except TIMEOUT_ERRORS:
+        yield TRUNCATED_MSG if started else TIMEOUT_MSG
+    except CircuitOpenError:
+        yield LLM_DOWN_MSG
+
+def _store_when_done(deltas: Iterator[str], store: Callable[[str], None]) -> Iterator[str]:
+    """Pass deltas through and hand the full answer to store once the stream completes."""
+    parts = []
+    for delta in deltas:
+        parts.append(delta)
+        yield delta
+    if not {TRUNCATED_MSG, TIMEOUT_MSG, LLM_DOWN_MSG} & set(parts):
+        store("".join(parts))
+
+def llm_unavailable(client, deadline: Deadline) -> Optional[str]:
+    """The reply when no completion can be tried: no client, or too little time left."""
+    if not client:
+        return NO_GROQ_MSG
+    if deadline.remaining() < MIN_LLM_BUDGET_S:
+        return TIMEOUT_MSG
+    return None
+
+def llm_failed(exc: BaseException) -> str:
+    """The reply for a completion that timed out or found the circuit open."""
+    return LLM_DOWN_MSG if isinstance(exc, CircuitOpenError) else TIMEOUT_MSG
+
+def cached_ai_answer(prompt: str) -> Optional[str]:
+    cached = shared_cache.get(answer_key("ai", prompt))
+    if cached is None:
+        index = _semantic("ai")
+        cached = index.lookup(prompt) if index else None
+    return cached
+
+def store_ai_answer(prompt: str, answer: str) -> None:
+    if not answer:
+        return
+    shared_cache.set(answer_key("ai", prompt), answer, ANSWER_CACHE_TTL_S)
+    index = _semantic("ai")
+    if index:
+        index.add(prompt, answer)
+
+def generate_ai_response(prompt: str, use_cache: bool = True,
+                         deadline: Optional[Deadline] = None) -> str:
+    if use_cache:
+        cached = cached_ai_answer(prompt)
+        if cached is not None:
+            return cached
+
+    client = _groq()
+    deadline = deadline or Deadline(REQUEST_DEADLINE_S)
+    reply = llm_unavailable(client, deadline)
+    if reply is not None:
+        return reply
+
+    def complete() -> str:
+        answer = _complete(client, AI_MODEL, ai_messages(prompt), 0.6, deadline)
+        store_ai_answer(prompt, answer)
+        return answer
+
+    try:
+        answer = llm_flight.do(answer_key("ai", prompt), complete, timeout=deadline.remaining())
+    except _DEGRADE_ERRORS as exc:
+        return llm_failed(exc)
+    return answer or "(No response)"
+
+def stream_ai_response(prompt: str, use_cache: bool = True,
+                       deadline: Optional[Deadline] = None) -> Iterator[str]:
+    if use_cache:
+        cached = cached_ai_answer(prompt)
+        if cached is not None:
+            yield cached
+            return
+
+    client = _groq()
+    deadline = deadline or Deadline(REQUEST_DEADLINE_S)
+    reply = llm_unavailable(client, deadline)
+    if reply is not None:
+        yield reply
+        return
+    yield from _store_when_done(
+        _stream_completion(client, AI_MODEL, ai_messages(prompt), 0.6, deadline),
+        lambda answer: store_ai_answer(prompt, answer),
+    )
 
+# Web answers are stored as {"answer", "fresh_until"}: past fresh_until they are
+# still served (flagged stale) while one background refresh runs, until the
+# hard TTL removes them.
+SWR_STATS = {"stale_served": 0, "refreshes": 0, "refresh_errors": 0}
+_refresh_pool = ThreadPoolExecutor(max_workers=REFRESH_WORKERS, thread_name_prefix="swr-refresh")
+_refreshing: set = set()
+_refreshing_lock = threading.Lock()
+
+def store_web_answer(query: str, k: int, depth: str, answer: str) -> None:
+    shared_cache.set(
+        answer_key("web", query, depth, k),
+        {"answer": answer, "fresh_until": time.time() + WEB_ANSWER_SOFT_TTL_S},
+        WEB_ANSWER_HARD_TTL_S,
+    )
+    index = _semantic("web", depth, k)
+    if index:
+        index.add(query, answer)
+
+def cached_web_answer(query: str, k: int = 5, depth: str = "basic") -> Optional[Tuple[str, bool]]:
+    """
+    (answer, stale) from the shared cache, scheduling a refresh for stale hits;
+    falls back to a paraphrase match, which is never stale.
+    """
+    key = answer_key("web", query, depth, k)
+    cached = shared_cache.get(key)
+    if not isinstance(cached, dict):
+        index = _semantic("web", depth, k)
+        answer = index.lookup(query) if index else None
+        return (answer, False) if answer is not None else None
+    stale = cached["fresh_until"] <= time.time()
+    if stale:
+        count_stat(SWR_STATS, "stale_served")
+        _schedule_refresh(key, query, k, depth)
+    return cached["answer"], stale
+
+def _schedule_refresh(key: str, query: str, k: int, depth: str) -> None:
+    # Single flight: one refresh per key in this worker, and a short lease in
+    # the shared cache so other workers do not start their own.
+    with _refreshing_lock:
+        if key in _refreshing:
+            return
+        _refreshing.add(key)
+    if not shared_cache.add("lease|" + key, os.getpid(), 30.0):
+        with _refreshing_lock:
+            _refreshing.discard(key)
+        return
+
+    def refresh() -> None:
+        try:
+            answer_with_web_search(query, k=k, depth=depth, use_cache=False)
+            count_stat(SWR_STATS, "refreshes")
+        except Exception as exc:
+            count_stat(SWR_STATS, "refresh_errors")
+            app.logger.warning("Background refresh failed: %s", exc)
+        finally:
+            with _refreshing_lock:
+                _refreshing.discard(key)
+
+    _refresh_pool.submit(refresh)
+
+def answer_with_web_search(query: str, k: int = 5, depth: str = "basic",
+                           use_cache: bool = True, deadline: Optional[Deadline] = None) -> str:
+    """Search + synthesis; the answer cache is read by cached_web_answer, only written here."""
+    deadline = deadline or Deadline(REQUEST_DEADLINE_S)
+    key = answer_key("web", query, depth, k)
+    try:
+        return llm_flight.do(
+            key, lambda: _answer_with_web_search(query, k, depth, use_cache, deadline),
+            timeout=deadline.remaining(),
+        )
+    except TIMEOUT_ERRORS:
+        return TIMEOUT_MSG
+
+def search_timeout(deadline: Deadline) -> float:
+    return deadline.budget(SEARCH_BUDGET_SHARE, cap=SEARCH_TIMEOUT_S)
+
+def search_note(exc: BaseException) -> str:
+    return SEARCH_DOWN_NOTE if isinstance(exc, CircuitOpenError) else SEARCH_TIMEOUT_NOTE
+
+# The steps of a web-search answer, shared with asgi.py: the two servers
+# differ only in how they wait for Tavily and Groq in between.
+def search_fallback(query: str, exc: BaseException, client, deadline: Deadline,
+                     degrade: tuple = _DEGRADE_ERRORS) -> Tuple[Optional[str], List[dict]]:
+    """After a failed search: (reply, []) to answer with, or (None, messages) for an ungrounded answer."""
+    if not isinstance(exc, degrade):
+        app.logger.error("Tavily error: %s", exc)
+        return "Web search is temporarily unavailable.", []
+    # Degrade to an ungrounded answer with whatever budget is left.
+    app.logger.warning("Tavily unavailable: %s", exc)
+    reply = llm_unavailable(client, deadline)
+    if reply is not None:
+        return reply, []
+    return None, ai_messages(query)
+
+def grounded_prompt(query: str, results: List[SearchItem], k: int, client,
+                     deadline: Deadline) -> Tuple[Optional[str], List[dict], List[SearchItem]]:
+    """
+    After a search: (reply, [], sources) to answer with, or (None, messages,
+    sources) to synthesise from; sources are the ones cited, possibly none.
+    """
+    results = select_sources(query, results, k)
+    if not results:
+        return "No results found.", [], []
+    if not client:
+        return NO_GROQ_MSG, [], []
+    # Out of time for synthesis: the sources alone are the partial answer.
+    if deadline.remaining() < MIN_LLM_BUDGET_S:
+        return TIMEOUT_MSG + sources_footer(results), [], results
+    with stage("prompt"):
+        messages, results = _web_messages(query, results)
+    return None, messages, results
+
+def _answer_with_web_search(query: str, k: int, depth: str, use_cache: bool,
+                            deadline: Deadline) -> str:
+    try:
+        with stage("search"):
+            results = web_search(query, k, depth, use_cache, search_timeout(deadline))
+    except Exception as exc:
+        client = _groq()
+        reply, messages = search_fallback(query, exc, client, deadline)
+        if reply is not None:
+            return reply
+        try:
+            return search_note(exc) + _complete(client, WEB_MODEL, messages, 0.6, deadline)
+        except _DEGRADE_ERRORS as llm_exc:
+            return llm_failed(llm_exc)
+
+    client = _groq()
+    reply, messages, results = grounded_prompt(query, results, k, client, deadline)
+    if reply is not None:
+        return reply
+    try:
+        answer = _complete(client, WEB_MODEL, messages, 0.3, deadline)
+    except _DEGRADE_ERRORS as exc:
+        return llm_failed(exc) + sources_footer(results)
+    answer += sources_footer(results)
+    store_web_answer(query, k, depth, answer)
+    return answer
+
+def stream_web_search(query: str, k: int = 5, depth: str = "basic", use_cache: bool = True,
+                      deadline: Optional[Deadline] = None) -> Iterator[Union[str, dict]]:
+    """Answer deltas; a sources_event dict comes first, as soon as the sources are chosen."""
+    deadline = deadline or Deadline(REQUEST_DEADLINE_S)
+    try:
+        with stage("search"):
+            results = web_search(query, k, depth, use_cache, search_timeout(deadline))
+    except Exception as exc:
+        client = _groq()
+        reply, messages = search_fallback(query, exc, client, deadline)
+        if reply is not None:
+            yield reply
+        else:
+            yield search_note(exc)
+            yield from _stream_completion(client, WEB_MODEL, messages, 0.6, deadline)
+        return
+
+    client = _groq()
+    reply, messages, results = grounded_prompt(query, results, k, client, deadline)
+    if results:
+        yield sources_event(results)
+    if reply is not None:
+        yield reply
+        return
+
+    def deltas() -> Iterator[str]:
+        yield from _stream_completion(client, WEB_MODEL, messages, 0.3, deadline)
+        yield sources_footer(results)
+
+    yield from _store_when_done(deltas(), lambda answer: store_web_answer(query, k, depth, answer))
+
+
+# ---------- Routing ----------
+# mode="auto" decides per message whether a web search is worth its latency.
+# Unambiguous cues (a URL, "latest", "today", "write a ...", code, arithmetic)
+# decide outright; everything else goes to a naive Bayes model over words and
+# word pairs, trained at import on the examples below plus ROUTE_EXAMPLES_PATH
+# (JSON lines: {"text": "...", "mode": "ai" | "web"}).
+ROUTE_STATS = {"ai": 0, "web": 0, "heuristic": 0, "model": 0, "default": 0}
+route_log = app.logger.getChild("route")  # one line per decision, for tuning
+
+# Explicit requests to search (or a URL to read) beat everything else; then an
+# imperative task ("write me a poem about the news") stays with the model even
+# when it mentions something recent; then freshness cues mean a search.
+_ROUTE_SEARCH = re.compile(
+    r"https?://|\bwww\.|\b[\w-]+\.(?:com|org|net|io|dev|ai|gov|edu)\b"
+    r"|\b(?:search (?:for|the web|online)|look up|google for)\b", re.I)
+_ROUTE_WEB = re.compile(
+    r"\b(?:today|tonight|yesterday|tomorrow|latest|newest|recently|currently|right now"
+    r"|this (?:week|month|year)|news|headlines?|prices?|stock|weather|forecast|scores?|standings"
+    r"|release date|who won|election|20[2-9]\d)\b", re.I)
+_ROUTE_AI = re.compile(
+    r"^\s*(?:please\s+)?(?:write|rewrite|translate|summari[sz]e|explain|define|solve|calculate|compute|prove"
+    r"|refactor|debug|fix|convert|draft|compose|brainstorm|proofread|paraphrase)\b"
+    r"|```|\bdef \w+\(|\bfunction\s*\w*\(", re.I)
+# Arithmetic only when the message is the expression ("what is 2/3 of 90"):
+# inside a sentence, 2025-2026, 3-1 and 9/11 are years, scores and dates.
+_ROUTE_MATH = re.compile(
+    r"^\s*(?:(?:what(?:'s| is)|how much is|calculate|compute)\s+)?"
+    r"(?=[^a-z]*\d)(?:[-+*/^=().,%\d\s]|\b(?:of|x|plus|minus|times|divided by|squared|percent)\b)+[?.!]?\s*$",
+    re.I)
+
+_ROUTE_SEED = [
+    ("Who is the CEO of OpenAI", "web"), ("What happened to Silicon Valley Bank", "web"),
+    ("Best restaurants near Union Square", "web"), ("When does the iPhone 17 come out", "web"),
+    ("Did the Lakers win last night", "web"), ("When is the next SpaceX launch", "web"),
+    ("How much does a Tesla Model 3 cost", "web"), ("What is Bitcoin trading at", "web"),
+    ("Is the Golden Gate Bridge closed", "web"), ("New features in Python 3.14", "web"),
+    ("Opening hours of the Louvre", "web"), ("Who is playing at Coachella", "web"),
+    ("Ticket prices for the World Cup final", "web"), ("What did the president say in his speech", "web"),
+    ("Reviews of the new Pixel phone", "web"), ("Flight status UA 123", "web"),
+    ("Who is the prime minister of Japan", "web"), ("Nvidia earnings report", "web"),
+    ("Taylor Swift tour dates", "web"), ("Best laptops for students", "web"),
+    ("Population of Lagos", "web"), ("Who won the Nobel Prize in physics", "web"),
+    ("Is ChatGPT down", "web"), ("Apple stock split", "web"),
+    ("What is a monad", "ai"), ("How do I reverse a linked list", "ai"),
+    ("Give me a recipe idea with chickpeas", "ai"), ("What is the difference between TCP and UDP", "ai"),
+    ("Why is the sky blue", "ai"), ("How does photosynthesis work", "ai"),
+    ("Tips for a job interview", "ai"), ("What rhymes with orange", "ai"),
+    ("Help me name my cat", "ai"), ("How do I center a div", "ai"),
+    ("What causes inflation", "ai"), ("Tell me a joke", "ai"),
+    ("How should I structure a cover letter", "ai"), ("How do I make pancakes", "ai"),
+    ("Meaning of the word ephemeral", "ai"), ("How to make my code faster", "ai"),
+    ("What is a closure in JavaScript", "ai"), ("How does binary search work", "ai"),
+    ("Can you help me plan a workout", "ai"), ("What is the Pythagorean theorem", "ai"),
+    ("How do vaccines work", "ai"), ("Give me feedback on my essay", "ai"),
+    ("What are good habits for sleep", "ai"), ("How do I say thank you in Japanese", "ai"),
+]
+
+class RouteModel:
+    """Multinomial naive Bayes with add-one smoothing; trains in well under a millisecond."""
+
+    def __init__(self, examples: List[Tuple[str, str]]):
+        self.docs: Counter = Counter()
+        self.counts = {"ai": Counter(), "web": Counter()}
+        for text, label in examples:
+            self.docs[label] += 1
+            self.counts[label].update(self._features(text))
+        self.totals = {label: sum(c.values()) for label, c in self.counts.items()}
+        self.vocab = len(set(self.counts["ai"]) | set(self.counts["web"]))
+
+    SHAPE_WEIGHT = 0.5
+
+    @staticmethod
+    def _features(text: str) -> List[str]:
+        words = _terms(text)
+        # Names and numbers past the first word hint at specific, checkable facts.
+        shape = ["<num>" if w[:1].isdigit() else "<name>" for w in text.split()[1:]
+                 if w[:1].isdigit() or (w[:1].isupper() and w != "I" and not w.startswith("I'"))]
+        return words + [f"{a}_{b}" for a, b in zip(words, words[1:])] + shape
+
+    def p_web(self, text: str) -> Optional[float]:
+        """P(web), or None when no word of text was seen in training (no evidence either way)."""
+        # Features never seen in training are skipped rather than smoothed, so
+        # they do not favour whichever class has fewer features. Shape features
+        # only adjust, at half weight, a decision the words already support.
+        known = [f for f in self._features(text) if f in self.counts["ai"] or f in self.counts["web"]]
+        if not any(not f.startswith("<") for f in known):
+            return None
+        n = sum(self.docs.values())
+        logp = {}
+        for label in ("ai", "web"):
+            lp = math.log(self.docs[label] / n)
+            denom = self.totals[label] + self.vocab
+            for f in known:
+                weight = self.SHAPE_WEIGHT if f.startswith("<") else 1.0
+                lp += weight * math.log((self.counts[label][f] + 1) / denom)
+            logp[label] = lp
+        return 1.0 / (1.0 + math.exp(max(-50.0, min(50.0, logp["ai"] - logp["web"]))))
+
+def _route_examples(path: str) -> List[Tuple[str, str]]:
+    examples = list(_ROUTE_SEED)
+    if not path:
+        return examples
+    try:
+        with open(path, encoding="utf-8") as f:
+            for line in f:
+                if line.strip():
+                    ex = json.loads(line)
+                    examples.append((ex["text"], "web" if ex["mode"] in WEB_MODES else "ai"))
+    except (OSError, ValueError, KeyError, TypeError) as e:
+        app.logger.warning("Ignoring ROUTE_EXAMPLES_PATH %s: %s", path, e)
+    return examples
+
+WEB_MODES = ("web", "web-search", "search")
+route_model = RouteModel(_route_examples(ROUTE_EXAMPLES_PATH))
+
+def route(text: str) -> Tuple[str, str, Optional[float]]:
+    """(decision "ai" | "web", deciding rule, model P(web) or None)."""
+    if _ROUTE_SEARCH.search(text):
+        return "web", "heuristic", None
+    if _ROUTE_AI.search(text) or _ROUTE_MATH.match(text):
+        return "ai", "heuristic", None
+    if _ROUTE_WEB.search(text):
+        return "web", "heuristic", None
+    p = route_model.p_web(text)
+    if p is None:  # nothing to go on: the cheaper, faster answer
+        return "ai", "default", None
+    return ("web" if p >= ROUTE_WEB_THRESHOLD else "ai"), "model", p
+
+def resolve_mode(mode: str, text: str) -> Tuple[str, Optional[str]]:
+    """(mode to answer in, routing decision or None when mode was not "auto")."""
+    if mode != "auto":
+        return mode, None
+    t0 = time.perf_counter()
+    decision, by, p = route(text)
+    dt = time.perf_counter() - t0
+    count_stat(ROUTE_STATS, decision)
+    count_stat(ROUTE_STATS, by)
+    metrics.observe("boog_route_seconds", dt, decision=decision, by=by)
+    note_timing("route", decision)
+    route_log.info("route=%s by=%s p_web=%s us=%d q=%r", decision, by,
+                   "-" if p is None else f"{p:.3f}", dt * 1e6, text[:200])
+    return ("web-search" if decision == "web" else "ai"), decision
 
 # ---------- Flask Routes ----------------------------------------------------
 @app.route("/")
@@ -136,26 +2202,212 @@ def index():
     return render_template("index.html")
 
 
-@app.route("/chat", methods=["POST"])
-def chat():
+def _chat_payload() -> tuple:
     payload = request.get_json(silent=True) or {}
     user_input: str = (payload.get("message") or "").strip()
-    mode: str = (payload.get("mode") or "ai").lower()  # "ai" | "web"
+    mode: str = (payload.get("mode") or "ai").lower()  # "ai" | "web" | "auto"
+    return payload, user_input, mode
+
+def request_deadline(payload: dict) -> Deadline:
+    """REQUEST_DEADLINE_S, or the payload's "deadline_ms" clamped to [REQUEST_DEADLINE_MIN_S, REQUEST_DEADLINE_MAX_S]."""
+    try:
+        seconds = float(payload["deadline_ms"]) / 1000.0
+    except (KeyError, TypeError, ValueError):
+        seconds = REQUEST_DEADLINE_S
+    if seconds != seconds:  # NaN
+        seconds = REQUEST_DEADLINE_S
+    return Deadline(min(max(seconds, REQUEST_DEADLINE_MIN_S), REQUEST_DEADLINE_MAX_S))
+
+
+def _answer_chat(payload: dict, user_input: str, mode: str, deadline: Deadline) -> Tuple[str, bool]:
+    """(response, stale) for one /chat request."""
+    use_cache = not payload.get("no_cache")
+
+    if mode in WEB_MODES:
+        hit = cached_web_answer(user_input, k=5, depth=SEARCH_DEPTH) if use_cache else None
+        if hit:
+            return hit
+        return answer_with_web_search(user_input, k=5, depth=SEARCH_DEPTH,
+                                      use_cache=use_cache, deadline=deadline), False
+    return generate_ai_response(user_input, use_cache=use_cache, deadline=deadline), False
+
+
+@app.route("/chat", methods=["POST"])
+def chat():
+    payload, user_input, mode = _chat_payload()
 
     if not user_input:
         return jsonify(response="Please provide a message.")
 
-    if mode in ("web", "web-search", "search"):
-        # You can flip to depth="advanced" for tougher queries (costs 2 credits).
-        resp = answer_with_web_search(user_input, k=5, depth="basic")
+    deadline = request_deadline(payload)
+    timings = begin_timings()
+    try:
+        with stage("queue"):
+            admitted_at = admission.acquire(deadline)
+    except Overloaded:
+        return _overloaded()
+    try:
+        with stage("total"):
+            mode, routed = resolve_mode(mode, user_input)
+            resp, stale = _answer_chat(payload, user_input, mode, deadline)
+            with stage("serialize"):
+                body = {"response": resp}
+                if stale:
+                    body["stale"] = True
+                if routed:
+                    body["mode"] = routed
+                out = jsonify(body)
+    finally:
+        admission.release(admitted_at)
+    out.headers["Server-Timing"] = server_timing(timings)
+    return out
+
+
+def _overloaded() -> Response:
+    out = jsonify(response=OVERLOADED_MSG, error="overloaded")
+    out.status_code = 503
+    out.headers["Retry-After"] = str(retry_after())
+    return out
+
+
+@app.route("/chat/stream", methods=["POST"])
+def chat_stream():
+    """
+    Same contract as /chat, but answers as NDJSON: {"delta": ...} lines, then
+    {"done": true}. Web searches send {"sources": [...]} before the first delta.
+    """
+    payload, user_input, mode = _chat_payload()
+    use_cache = not payload.get("no_cache")
+    deadline = request_deadline(payload)
+    admitted_at = None
+    if user_input:
+        try:
+            admitted_at = admission.acquire(deadline)
+        except Overloaded:
+            return _overloaded()
+
+    stale = False
+    mode, routed = resolve_mode(mode, user_input) if user_input else (mode, None)
+    if not user_input:
+        deltas: Iterator[Union[str, dict]] = iter(["Please provide a message."])
+    elif mode in WEB_MODES:
+        hit = cached_web_answer(user_input, k=5, depth=SEARCH_DEPTH) if use_cache else None
+        if hit:
+            deltas, stale = iter([hit[0]]), hit[1]
+        else:
+            deltas = stream_web_search(user_input, k=5, depth=SEARCH_DEPTH,
+                                       use_cache=use_cache, deadline=deadline)
     else:
-        resp = generate_ai_response(user_input)
+        deltas = stream_ai_response(user_input, use_cache=use_cache, deadline=deadline)
+
+    t0 = time.perf_counter()
+
+    def ndjson() -> Iterator[str]:
+        try:
+            if routed:
+                yield json.dumps({"mode": routed}) + "\n"
+            if stale:
+                yield json.dumps({"stale": True}) + "\n"
+            try:
+                for delta in deltas:
+                    yield json.dumps(delta if isinstance(delta, dict) else {"delta": delta}) + "\n"
+            except Exception as exc:
+                app.logger.error("Stream error: %s", exc)
+                yield json.dumps({"error": "Upstream error while generating the answer."}) + "\n"
+            yield json.dumps({"done": True}) + "\n"
+            metrics.observe("boog_stage_seconds", time.perf_counter() - t0, stage="total")
+        except GeneratorExit:
+            # The server closes the response when a write to the client fails.
+            count_stat(CANCEL_STATS, "requests")
+            raise
+        finally:
+            close = getattr(deltas, "close", None)
+            if close:
+                close()  # stops the Groq stream now instead of at garbage collection
+
+    out = Response(
+        stream_with_context(ndjson()),
+        mimetype="application/x-ndjson",
+        headers={"Cache-Control": "no-cache", "X-Accel-Buffering": "no"},
+    )
+    if admitted_at is not None:
+        # Called by the server once the response is done, even if it was never sent.
+        out.call_on_close(lambda: admission.release(admitted_at))
+    return out
+
+
+def stats_payload() -> dict:
+    return dict(
+        pid=os.getpid(),
+        groq=groq_pool_stats(),
+        search_cache=search_cache.snapshot(),
+        shared_cache=shared_cache.snapshot(),
+        swr=dict(SWR_STATS),
+        coalescing={"search": dict(search_flight.stats), "llm": dict(llm_flight.stats)},
+        semantic_cache=semantic_stats(),
+        route=dict(ROUTE_STATS),
+        cancel=dict(CANCEL_STATS),
+        escalation=escalation_stats(),
+        retries=retry_stats(),
+        breakers={"tavily": tavily_breaker.snapshot(), "groq": groq_breaker.snapshot()},
+        admission=dict(ADMISSION_STATS, **ADMISSION_LOAD),
+        fanout=dict(FANOUT_STATS),
+        dedup=dict(DEDUP_STATS),
+        rerank=dict(RERANK_STATS),
+        prompt=dict(PROMPT_STATS),
+        upstreams={"tavily_url": TAVILY_URL, "groq_base_url": GROQ_BASE_URL,
+                   "ai_model": AI_MODEL, "web_model": WEB_MODEL},
+    )
+
+
+def _collect_counters() -> Iterator[tuple]:
+    """Feature counters kept elsewhere, exported through /metrics."""
+    caches = [("search", search_cache.stats), ("shared", shared_cache.stats)]
+    caches += [("semantic:" + name, st) for name, st in semantic_stats().items()]
+    for cache, st in caches:
+        for event, value in dict(st).items():
+            yield "boog_cache_events_total", {"cache": cache, "event": event}, value
+    features = [
+        ("groq_pool", GROQ_STATS),
+        ("swr", SWR_STATS),
+        ("route", ROUTE_STATS),
+        ("cancel", CANCEL_STATS),
+        ("escalation", ESCALATION_STATS),
+        ("retry", RETRY_STATS),
+        ("breaker_tavily", tavily_breaker.stats),
+        ("breaker_groq", groq_breaker.stats),
+        ("admission", ADMISSION_STATS),
+        ("fanout", FANOUT_STATS),
+        ("dedup", DEDUP_STATS),
+        ("rerank", RERANK_STATS),
+        ("prompt", PROMPT_STATS),
+        ("coalesce_search", search_flight.stats),
+        ("coalesce_llm", llm_flight.stats),
+    ]
+    for feature, st in features:
+        for event, value in dict(st).items():
+            yield "boog_events_total", {"feature": feature, "event": event}, value
+    yield "boog_admission_in_flight", {}, ADMISSION_LOAD["in_flight"]
+    yield "boog_admission_queue_depth", {}, ADMISSION_LOAD["waiting"]
+
+metrics.collectors.append(_collect_counters)
+
+
+@app.route("/stats")
+def stats():
+    """Per-worker counters (each gunicorn worker answers for itself)."""
+    return jsonify(stats_payload())
+
 
-    return jsonify(response=resp)
+@app.route("/metrics")
+def metrics_endpoint():
+    """Prometheus metrics summed over all workers."""
+    return Response(metrics.render(), mimetype="text/plain; version=0.0.4")
 
 
 # ---------- Entrypoint ------------------------------------------------------
 if __name__ == "__main__":
     port = int(os.environ.get("PORT", 5000))
+    warm_up()
     # Setting threaded=True plays nicer with Groq and HTTP requests concurrency
     app.run(host="0.0.0.0", port=port, threaded=True)
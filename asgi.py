@@ -0,0 +1,714 @@
+"""
+Async serving mode: the same `/`, `/chat` and `/chat/stream` contract as app.py,
+served as a plain ASGI app. Tavily and Groq are awaited (httpx.AsyncClient,
+AsyncGroq), so one process holds many concurrent chats instead of one per
+sync worker. Caches, prompts and settings are shared with app.py, and so
+is every decision (retries, escalation, fan-out merging, degradation
+messages): this module only awaits the I/O between app.py's steps, and
+uses only app.py's public (non-underscore) names.
+
+    gunicorn asgi:app -k uvicorn.workers.UvicornWorker
+"""
+import os, json, time, asyncio, mimetypes
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, List, Optional, Union
+
+import httpx
+from groq import AsyncGroq, DefaultAsyncHttpxClient
+from flask import render_template
+
+import app as boog
+
+STATIC_DIR = os.path.join(os.path.dirname(os.path.abspath(__file__)), "static")
+
+
+# ---------- Clients ----------
+# Created on first use inside the worker's event loop (after fork).
+_http: Optional[httpx.AsyncClient] = None
+_groq_client: Optional[AsyncGroq] = None
+
+def _http_client() -> httpx.AsyncClient:
+    global _http
+    if _http is None:
+        _http = httpx.AsyncClient(
+            http2=boog.TAVILY_HTTP2 and boog.HAVE_H2,
+            limits=httpx.Limits(
+                max_connections=boog.TAVILY_POOL_SIZE,
+                max_keepalive_connections=boog.TAVILY_POOL_SIZE,
+            ),
+        )
+    return _http
+
+def _groq() -> Optional[AsyncGroq]:
+    global _groq_client
+    key = os.getenv("GROQ_API_KEY", "")
+    if not key:
+        return None
+    if _groq_client is None:
+        _groq_client = AsyncGroq(
+            api_key=key,
+            base_url=boog.GROQ_BASE_URL,
+            http_client=DefaultAsyncHttpxClient(
+                limits=httpx.Limits(
+                    max_connections=boog.GROQ_POOL_SIZE,
+                    max_keepalive_connections=boog.GROQ_POOL_SIZE,
+                    keepalive_expiry=boog.GROQ_KEEPALIVE_S,
+                ),
+                http2=boog.GROQ_HTTP2 and boog.HAVE_H2,
+            ),
+        )
+    return _groq_client
+
+
+# ---------- Coalescing ----------
+class AsyncSingleFlight:
+    """asyncio counterpart of app.SingleFlight: one task per key, awaited by all callers."""
+
+    def __init__(self):
+        self.stats = {"calls": 0, "coalesced": 0, "aborted": 0}
+        self._tasks: dict = {}
+        self._waiters: dict = {}
+
+    async def do(self, key: str, fn: Callable[[], Awaitable], timeout: Optional[float] = None):
+        task = self._tasks.get(key)
+        if task is None:
+            self.stats["calls"] += 1
+            task = self._tasks[key] = asyncio.ensure_future(fn())
+
+            def done(t: asyncio.Future) -> None:
+                self._tasks.pop(key, None)
+                if not t.cancelled():
+                    t.exception()  # retrieved even if every waiter gave up
+
+            task.add_done_callback(done)
+        else:
+            self.stats["coalesced"] += 1
+        self._waiters[task] = self._waiters.get(task, 0) + 1
+        try:
+            # shield: a caller that times out must not cancel the shared call
+            return await asyncio.wait_for(asyncio.shield(task), timeout)
+        except asyncio.CancelledError:
+            # The caller was cancelled (client disconnect): abort the upstream
+            # call too, unless another request is still waiting for it.
+            if self._waiters[task] == 1 and not task.done():
+                self.stats["aborted"] += 1
+                task.cancel()
+            raise
+        finally:
+            self._waiters[task] -= 1
+            if not self._waiters[task]:
+                del self._waiters[task]
+
+search_flight = AsyncSingleFlight()
+llm_flight = AsyncSingleFlight()
+
+
+# ---------- Admission control ----------
+class AsyncAdmissionController:
+    """asyncio counterpart of app.AdmissionController; waiters are served in arrival order."""
+
+    def __init__(self, limit: int, queue: int):
+        self.limit = limit
+        self.queue = queue
+        self._active = 0
+        self._waiters: deque = deque()  # futures resolved when a slot is handed over
+
+    async def acquire(self, deadline: boog.Deadline) -> float:
+        t0 = time.monotonic()
+        if self.limit <= 0:
+            return t0
+        if self._active < self.limit and not self._waiters:
+            self._active += 1
+        elif len(self._waiters) >= self.queue:
+            boog.record_admission(0.0, "queue_full")
+            raise boog.Overloaded("queue_full")
+        else:
+            waiter = asyncio.get_running_loop().create_future()
+            self._waiters.append(waiter)
+            boog.count_stat(boog.ADMISSION_STATS, "queued")
+            boog.count_stat(boog.ADMISSION_LOAD, "waiting")
+            try:
+                await asyncio.wait_for(waiter, boog.admission_wait(deadline))
+            except BaseException as exc:
+                if waiter.done() and not waiter.cancelled():
+                    self._hand_over()  # granted a slot just as we gave up: pass it on
+                if isinstance(exc, asyncio.TimeoutError):
+                    boog.record_admission(time.monotonic() - t0, "timeout")
+                    raise boog.Overloaded("timeout") from None
+                raise
+            finally:
+                if waiter in self._waiters:
+                    self._waiters.remove(waiter)
+                boog.count_stat(boog.ADMISSION_LOAD, "waiting", -1)
+        boog.count_stat(boog.ADMISSION_LOAD, "in_flight")
+        now = time.monotonic()
+        boog.record_admission(now - t0)
+        return now
+
+    def release(self, admitted_at: float) -> None:
+        if self.limit <= 0:
+            return
+        boog.record_service_time(time.monotonic() - admitted_at)
+        boog.count_stat(boog.ADMISSION_LOAD, "in_flight", -1)
+        self._hand_over()
+
+    def _hand_over(self) -> None:
+        while self._waiters:
+            waiter = self._waiters.popleft()
+            if not waiter.done():
+                waiter.set_result(None)  # the slot moves to the next waiter
+                return
+        self._active -= 1
+
+admission = AsyncAdmissionController(boog.ADMIT_CONCURRENCY, boog.ADMIT_QUEUE)
+
+
+# ---------- Tavily search ----------
+async def tavily_search(query: str, k: int = 5, depth: str = "basic", use_cache: bool = True,
+                        timeout: float = boog.SEARCH_TIMEOUT_S) -> List[boog.SearchItem]:
+    key = boog.search_key(query, k, depth)
+    if use_cache:
+        cached = await asyncio.to_thread(boog.cached_search, key)
+        if cached is not None:
+            return cached
+
+    async def fetch() -> List[boog.SearchItem]:
+        headers, payload = boog.tavily_request(query, k, depth)
+        data = await _tavily_post(headers, payload, timeout)
+        items = boog.parse_results(data, k)
+        await asyncio.to_thread(boog.store_search, key, items)
+        return items
+
+    return [dict(it) for it in await search_flight.do(key, fetch, timeout=timeout)]
+
+async def _tavily_attempt(headers: dict, payload: dict, timeout: float) -> dict:
+    t0 = boog.attempt_started(timeout)
+    with boog.tavily_breaker.call(timeout), boog.upstream_call("tavily"):
+        r = await _http_client().post(boog.TAVILY_URL, headers=headers, json=payload, timeout=timeout)
+        r.raise_for_status()
+    boog.attempt_succeeded(payload, t0)
+    return r.json()
+
+async def _tavily_hedged(headers: dict, payload: dict, timeout: float) -> dict:
+    """app._tavily_hedged; the losing request is cancelled."""
+    delay = boog.hedge_delay(timeout)
+    if delay is None:
+        return await _tavily_attempt(headers, payload, timeout)
+    end = time.monotonic() + timeout
+    first = asyncio.ensure_future(_tavily_attempt(headers, payload, timeout))
+    pending = {first}
+    try:
+        done, _ = await asyncio.wait(pending, timeout=delay)
+        if done:
+            return first.result()
+        boog.count_stat(boog.RETRY_STATS, "hedged")
+        hedge = asyncio.ensure_future(_tavily_attempt(headers, payload, max(0.0, end - time.monotonic())))
+        pending.add(hedge)
+        error = None
+        while pending:
+            done, pending = await asyncio.wait(pending, timeout=max(0.0, end - time.monotonic()),
+                                               return_when=asyncio.FIRST_COMPLETED)
+            if not done:
+                raise TimeoutError("Tavily search timed out")
+            for t in done:
+                if t.exception() is None:
+                    if t is hedge:
+                        boog.count_stat(boog.RETRY_STATS, "hedge_wins")
+                    return t.result()
+                error = t.exception()
+        raise error
+    finally:
+        for t in pending:
+            t.cancel()
+
+async def _tavily_post(headers: dict, payload: dict, timeout: float) -> dict:
+    end = time.monotonic() + timeout
+    attempt = 0
+    while True:
+        try:
+            return await _tavily_hedged(headers, payload, boog.attempt_timeout(attempt, end))
+        except Exception as exc:
+            if not boog.retryable(exc):
+                raise
+            pause = boog.retry_pause(attempt, exc, end)
+            if pause is None:
+                raise
+        await asyncio.sleep(pause)
+        attempt += 1
+
+async def _search_one(query: str, k: int, depth: str, use_cache: bool, timeout: float) -> List[boog.SearchItem]:
+    """app._search_one; in race mode the losing advanced search is cancelled."""
+    if depth != "auto":
+        return await tavily_search(query, k=k, depth=depth, use_cache=use_cache, timeout=timeout)
+    t0 = time.monotonic()
+    boog.count_stat(boog.ESCALATION_STATS, "searches")
+    advanced = None
+    if boog.ESCALATE_RACE:
+        advanced = asyncio.ensure_future(
+            tavily_search(query, k=k, depth="advanced", use_cache=use_cache, timeout=timeout))
+        advanced.add_done_callback(lambda t: t.cancelled() or t.exception())
+    try:
+        basic = await tavily_search(query, k=k, depth="basic", use_cache=use_cache, timeout=timeout)
+    except BaseException:
+        if advanced is not None:
+            advanced.cancel()
+        raise
+    left = timeout - (time.monotonic() - t0)
+    if not boog.should_escalate(query, basic, k, left, racing=advanced is not None):
+        if advanced is not None:
+            advanced.cancel()
+        return basic
+    try:
+        with boog.stage("escalation"):
+            if advanced is None:
+                better = await tavily_search(query, k=k, depth="advanced", use_cache=use_cache, timeout=left)
+            else:
+                better = await asyncio.wait_for(advanced, max(0.0, left))
+    except Exception as exc:
+        boog.escalation_failed(exc)
+        return basic
+    return better if better else basic
+
+async def web_search(query: str, k: int, depth: str, use_cache: bool, timeout: float) -> List[boog.SearchItem]:
+    """app.web_search with the sub-queries gathered concurrently on the event loop."""
+    subs = boog.fanout_queries(query)
+    per_query = boog.fetch_k(k)
+    if len(subs) == 1:
+        return await _search_one(query, per_query, depth, use_cache, timeout)
+    outcomes = await asyncio.gather(
+        *(_search_one(q, per_query, depth, use_cache, timeout) for q in subs),
+        return_exceptions=True,
+    )
+    return boog.merge_fanout(subs, list(outcomes))
+
+
+# ---------- Groq LLM ----------
+Deadline = boog.Deadline
+_TIMEOUT_ERRORS = boog.TIMEOUT_ERRORS + (asyncio.TimeoutError,)
+_DEGRADE_ERRORS = _TIMEOUT_ERRORS + (boog.CircuitOpenError,)
+
+def _llm(client: AsyncGroq, deadline: Deadline) -> AsyncGroq:
+    return client.with_options(timeout=deadline.remaining(), max_retries=0)
+
+async def _complete(client: AsyncGroq, model: str, messages: List[dict], temperature: float,
+                    deadline: Deadline) -> str:
+    with boog.stage("llm"), boog.groq_breaker.call(deadline.remaining()), boog.upstream_call("groq"):
+        r = await _llm(client, deadline).chat.completions.create(
+            model=model, messages=messages, temperature=temperature,
+        )
+    boog.record_usage(r.usage)
+    return (r.choices[0].message.content or "").strip()
+
+async def _stream_completion(client: AsyncGroq, model: str, messages: List[dict], temperature: float,
+                             deadline: Deadline) -> AsyncIterator[str]:
+    started = False
+    streamed = 0
+    t0 = time.perf_counter()
+    try:
+        with boog.stage("llm"), boog.upstream_call("groq"):
+            with boog.groq_breaker.call(deadline.remaining()):
+                stream = await _llm(client, deadline).chat.completions.create(
+                    model=model, messages=messages, temperature=temperature, stream=True,
+                )
+            try:
+                async for chunk in stream:
+                    boog.record_usage(boog.chunk_usage(chunk))
+                    if deadline.expired():
+                        yield boog.TRUNCATED_MSG
+                        return
+                    if not chunk.choices:
+                        continue
+                    delta = chunk.choices[0].delta.content
+                    if delta:
+                        if not started:
+                            started = True
+                            boog.metrics.observe("boog_stage_seconds", time.perf_counter() - t0,
+                                                 stage="llm_first_token")
+                        streamed += 1
+                        yield delta
+            finally:
+                await stream.close()
+    except (GeneratorExit, asyncio.CancelledError):
+        boog.record_cancelled_stream(streamed)
+        raise
+    except _TIMEOUT_ERRORS:
+        yield boog.TRUNCATED_MSG if started else boog.TIMEOUT_MSG
+    except boog.CircuitOpenError:
+        yield boog.LLM_DOWN_MSG
+
+async def _store_when_done(deltas: AsyncIterator[str], store: Callable[[str], None]) -> AsyncIterator[str]:
+    parts = []
+    async for delta in deltas:
+        parts.append(delta)
+        yield delta
+    if not {boog.TRUNCATED_MSG, boog.TIMEOUT_MSG, boog.LLM_DOWN_MSG} & set(parts):
+        await asyncio.to_thread(store, "".join(parts))
+
+async def generate_ai_response(prompt: str, use_cache: bool = True,
+                               deadline: Optional[Deadline] = None) -> str:
+    if use_cache:
+        cached = await asyncio.to_thread(boog.cached_ai_answer, prompt)
+        if cached is not None:
+            return cached
+
+    client = _groq()
+    deadline = deadline or Deadline(boog.REQUEST_DEADLINE_S)
+    reply = boog.llm_unavailable(client, deadline)
+    if reply is not None:
+        return reply
+
+    async def complete() -> str:
+        answer = await _complete(client, boog.AI_MODEL, boog.ai_messages(prompt), 0.6, deadline)
+        await asyncio.to_thread(boog.store_ai_answer, prompt, answer)
+        return answer
+
+    try:
+        answer = await llm_flight.do(boog.answer_key("ai", prompt), complete,
+                                     timeout=deadline.remaining())
+    except _DEGRADE_ERRORS as exc:
+        return boog.llm_failed(exc)
+    return answer or "(No response)"
+
+async def stream_ai_response(prompt: str, use_cache: bool = True,
+                             deadline: Optional[Deadline] = None) -> AsyncIterator[str]:
+    if use_cache:
+        cached = await asyncio.to_thread(boog.cached_ai_answer, prompt)
+        if cached is not None:
+            yield cached
+            return
+
+    client = _groq()
+    deadline = deadline or Deadline(boog.REQUEST_DEADLINE_S)
+    reply = boog.llm_unavailable(client, deadline)
+    if reply is not None:
+        yield reply
+        return
+    async for delta in _store_when_done(
+        _stream_completion(client, boog.AI_MODEL, boog.ai_messages(prompt), 0.6, deadline),
+        lambda answer: boog.store_ai_answer(prompt, answer),
+    ):
+        yield delta
+
+async def answer_with_web_search(query: str, k: int = 5, depth: str = "basic",
+                                 use_cache: bool = True, deadline: Optional[Deadline] = None) -> str:
+    deadline = deadline or Deadline(boog.REQUEST_DEADLINE_S)
+    key = boog.answer_key("web", query, depth, k)
+    try:
+        return await llm_flight.do(
+            key, lambda: _answer_with_web_search(query, k, depth, use_cache, deadline),
+            timeout=deadline.remaining(),
+        )
+    except _TIMEOUT_ERRORS:
+        return boog.TIMEOUT_MSG
+
+async def _answer_with_web_search(query: str, k: int, depth: str, use_cache: bool,
+                                  deadline: Deadline) -> str:
+    try:
+        with boog.stage("search"):
+            results = await web_search(query, k, depth, use_cache, boog.search_timeout(deadline))
+    except Exception as exc:
+        client = _groq()
+        reply, messages = boog.search_fallback(query, exc, client, deadline, _DEGRADE_ERRORS)
+        if reply is not None:
+            return reply
+        try:
+            return boog.search_note(exc) + await _complete(client, boog.WEB_MODEL, messages, 0.6, deadline)
+        except _DEGRADE_ERRORS as llm_exc:
+            return boog.llm_failed(llm_exc)
+
+    client = _groq()
+    reply, messages, results = boog.grounded_prompt(query, results, k, client, deadline)
+    if reply is not None:
+        return reply
+    try:
+        answer = await _complete(client, boog.WEB_MODEL, messages, 0.3, deadline)
+    except _DEGRADE_ERRORS as exc:
+        return boog.llm_failed(exc) + boog.sources_footer(results)
+    answer += boog.sources_footer(results)
+    await asyncio.to_thread(boog.store_web_answer, query, k, depth, answer)
+    return answer
+
+async def stream_web_search(query: str, k: int = 5, depth: str = "basic", use_cache: bool = True,
+                            deadline: Optional[Deadline] = None) -> AsyncIterator[Union[str, dict]]:
+    deadline = deadline or Deadline(boog.REQUEST_DEADLINE_S)
+    try:
+        with boog.stage("search"):
+            results = await web_search(query, k, depth, use_cache, boog.search_timeout(deadline))
+    except Exception as exc:
+        client = _groq()
+        reply, messages = boog.search_fallback(query, exc, client, deadline, _DEGRADE_ERRORS)
+        if reply is not None:
+            yield reply
+        else:
+            yield boog.search_note(exc)
+            async for delta in _stream_completion(client, boog.WEB_MODEL, messages, 0.6, deadline):
+                yield delta
+        return
+
+    client = _groq()
+    reply, messages, results = boog.grounded_prompt(query, results, k, client, deadline)
+    if results:
+        yield boog.sources_event(results)
+    if reply is not None:
+        yield reply
+        return
+
+    async def deltas() -> AsyncIterator[str]:
+        async for delta in _stream_completion(client, boog.WEB_MODEL, messages, 0.3, deadline):
+            yield delta
+        yield boog.sources_footer(results)
+
+    async for delta in _store_when_done(
+        deltas(), lambda answer: boog.store_web_answer(query, k, depth, answer),
+    ):
+        yield delta
+
+
+# ---------- ASGI plumbing ----------
+async def _read_json(receive) -> dict:
+    body = b""
+    while True:
+        message = await receive()
+        body += message.get("body", b"")
+        if not message.get("more_body"):
+            break
+    try:
+        payload = json.loads(body or b"{}")
+    except ValueError:
+        return {}
+    return payload if isinstance(payload, dict) else {}
+
+async def _respond(send, status: int, body: bytes, content_type: str, headers=()) -> None:
+    await send({
+        "type": "http.response.start",
+        "status": status,
+        "headers": [(b"content-type", content_type.encode()), *headers],
+    })
+    await send({"type": "http.response.body", "body": body})
+
+async def _json(send, obj: dict, status: int = 200) -> None:
+    await _respond(send, status, json.dumps(obj).encode("utf-8"), "application/json")
+
+def _chat_payload(payload: dict) -> tuple:
+    user_input: str = (payload.get("message") or "").strip()
+    mode: str = (payload.get("mode") or "ai").lower()  # "ai" | "web" | "auto"
+    return user_input, mode, not payload.get("no_cache"), boog.request_deadline(payload)
+
+
+# ---------- Routes ----------
+_index_html: Optional[bytes] = None
+
+async def index(scope, receive, send) -> None:
+    global _index_html
+    if _index_html is None:
+        with boog.app.test_request_context("/"):
+            _index_html = render_template("index.html").encode("utf-8")
+    await _respond(send, 200, _index_html, "text/html; charset=utf-8")
+
+async def static(scope, receive, send) -> None:
+    rel = scope["path"][len("/static/"):]
+    path = os.path.normpath(os.path.join(STATIC_DIR, rel))
+    if not path.startswith(STATIC_DIR + os.sep) or not os.path.isfile(path):
+        await _respond(send, 404, b"Not Found", "text/plain")
+        return
+    with open(path, "rb") as fh:
+        data = fh.read()
+    await _respond(send, 200, data, mimetypes.guess_type(path)[0] or "application/octet-stream")
+
+async def _disconnected(receive) -> None:
+    while (await receive())["type"] != "http.disconnect":
+        pass
+
+async def _until_disconnect(receive, work: Awaitable) -> bool:
+    """Run work, cancelling it if the client disconnects first; True if it ran to completion."""
+    task = asyncio.ensure_future(work)
+    watcher = asyncio.ensure_future(_disconnected(receive))
+    try:
+        await asyncio.wait({task, watcher}, return_when=asyncio.FIRST_COMPLETED)
+    except asyncio.CancelledError:
+        task.cancel()
+        raise
+    finally:
+        watcher.cancel()
+    if task.done():
+        task.result()
+        return True
+    boog.count_stat(boog.CANCEL_STATS, "requests")
+    task.cancel()
+    try:
+        await task
+    except asyncio.CancelledError:
+        pass
+    return False
+
+async def _overloaded(send) -> None:
+    body = json.dumps({"response": boog.OVERLOADED_MSG, "error": "overloaded"}).encode("utf-8")
+    await _respond(send, 503, body, "application/json",
+                   headers=[(b"retry-after", str(boog.retry_after()).encode())])
+
+async def chat(scope, receive, send) -> None:
+    user_input, mode, use_cache, deadline = _chat_payload(await _read_json(receive))
+
+    if not user_input:
+        await _json(send, {"response": "Please provide a message."})
+        return
+
+    timings = boog.begin_timings()
+    try:
+        with boog.stage("queue"):
+            admitted_at = await admission.acquire(deadline)
+    except boog.Overloaded:
+        await _overloaded(send)
+        return
+    done = {}
+
+    async def answer() -> None:
+        with boog.stage("total"):
+            stale = False
+            resolved, routed = boog.resolve_mode(mode, user_input)
+            if resolved in boog.WEB_MODES:
+                hit = await asyncio.to_thread(boog.cached_web_answer, user_input, 5, boog.SEARCH_DEPTH) if use_cache else None
+                if hit:
+                    resp, stale = hit
+                else:
+                    resp = await answer_with_web_search(user_input, k=5, depth=boog.SEARCH_DEPTH,
+                                                        use_cache=use_cache, deadline=deadline)
+            else:
+                resp = await generate_ai_response(user_input, use_cache=use_cache, deadline=deadline)
+
+            with boog.stage("serialize"):
+                out = {"response": resp}
+                if stale:
+                    out["stale"] = True
+                if routed:
+                    out["mode"] = routed
+                done["body"] = json.dumps(out)
+
+    try:
+        if not await _until_disconnect(receive, answer()):
+            return
+    finally:
+        admission.release(admitted_at)
+    await _respond(send, 200, done["body"].encode("utf-8"), "application/json",
+                   headers=[(b"server-timing", boog.server_timing(timings).encode())])
+
+async def chat_stream(scope, receive, send) -> None:
+    user_input, mode, use_cache, deadline = _chat_payload(await _read_json(receive))
+    admitted_at = None
+    if user_input:
+        try:
+            admitted_at = await admission.acquire(deadline)
+        except boog.Overloaded:
+            await _overloaded(send)
+            return
+    try:
+        await _stream_answer(send, receive, user_input, mode, use_cache, deadline)
+    finally:
+        if admitted_at is not None:
+            admission.release(admitted_at)
+
+async def _stream_answer(send, receive, user_input: str, mode: str, use_cache: bool,
+                         deadline: Deadline) -> None:
+    async def one(text: str) -> AsyncIterator[str]:
+        yield text
+
+    stale = False
+    mode, routed = boog.resolve_mode(mode, user_input) if user_input else (mode, None)
+    if not user_input:
+        deltas = one("Please provide a message.")
+    elif mode in boog.WEB_MODES:
+        hit = await asyncio.to_thread(boog.cached_web_answer, user_input, 5, boog.SEARCH_DEPTH) if use_cache else None
+        if hit:
+            deltas, stale = one(hit[0]), hit[1]
+        else:
+            deltas = stream_web_search(user_input, k=5, depth=boog.SEARCH_DEPTH,
+                                       use_cache=use_cache, deadline=deadline)
+    else:
+        deltas = stream_ai_response(user_input, use_cache=use_cache, deadline=deadline)
+
+    await send({
+        "type": "http.response.start",
+        "status": 200,
+        "headers": [
+            (b"content-type", b"application/x-ndjson"),
+            (b"cache-control", b"no-cache"),
+            (b"x-accel-buffering", b"no"),
+        ],
+    })
+
+    async def line(obj: dict) -> None:
+        await send({"type": "http.response.body", "body": (json.dumps(obj) + "\n").encode("utf-8"), "more_body": True})
+
+    async def pump() -> None:
+        with boog.stage("total"):
+            if routed:
+                await line({"mode": routed})
+            if stale:
+                await line({"stale": True})
+            try:
+                async for delta in deltas:
+                    await line(delta if isinstance(delta, dict) else {"delta": delta})
+            except Exception as exc:
+                boog.app.logger.error("Stream error: %s", exc)
+                await line({"error": "Upstream error while generating the answer."})
+            await line({"done": True})
+            await send({"type": "http.response.body", "body": b""})
+
+    await _until_disconnect(receive, pump())
+
+async def stats(scope, receive, send) -> None:
+    payload = await asyncio.to_thread(boog.stats_payload)
+    payload["async_coalescing"] = {"search": dict(search_flight.stats), "llm": dict(llm_flight.stats)}
+    await _json(send, payload)
+
+async def metrics(scope, receive, send) -> None:
+    body = await asyncio.to_thread(boog.metrics.render)
+    await _respond(send, 200, body.encode("utf-8"), "text/plain; version=0.0.4")
+
+ROUTES = {
+    ("GET", "/"): index,
+    ("POST", "/chat"): chat,
+    ("POST", "/chat/stream"): chat_stream,
+    ("GET", "/stats"): stats,
+    ("GET", "/metrics"): metrics,
+}
+
+
+async def _lifespan(receive, send) -> None:
+    while True:
+        message = await receive()
+        if message["type"] == "lifespan.startup":
+            _groq()
+            _http_client()
+            boog.shared_cache.start_compactor()
+            asyncio.get_running_loop().run_in_executor(None, boog.load_encoder)
+            await send({"type": "lifespan.startup.complete"})
+        elif message["type"] == "lifespan.shutdown":
+            if _http is not None:
+                await _http.aclose()
+            if _groq_client is not None:
+                await _groq_client.close()
+            await send({"type": "lifespan.shutdown.complete"})
+            return
+
+async def app(scope, receive, send) -> None:
+    if scope["type"] == "lifespan":
+        await _lifespan(receive, send)
+        return
+    if scope["type"] != "http":
+        return
+
+    method, path = scope["method"], scope["path"]
+    if method in ("GET", "HEAD") and path.startswith("/static/"):
+        await static(scope, receive, send)
+        return
+    handler = ROUTES.get((method, path))
+    if handler is None:
+        allowed = any(p == path for _, p in ROUTES)
+        await _respond(send, 405 if allowed else 404, b"Method Not Allowed" if allowed else b"Not Found", "text/plain")
+        return
+    try:
+        await handler(scope, receive, send)
+    except Exception:
+        boog.app.logger.exception("Unhandled error on %s %s", method, path)
+        await _respond(send, 500, b"Internal Server Error", "text/plain")
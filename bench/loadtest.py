@@ -0,0 +1,190 @@
+"""
+Offline load test for Boog: drives /chat at a fixed arrival rate against local
+Tavily/Groq stand-ins (bench/stubs.py) and reports throughput plus per-stage
+latency percentiles taken from the Server-Timing header.
+
+    python bench/loadtest.py --rps 20 --duration 30 --mix ai=0.5,web=0.5
+    python bench/loadtest.py --url http://127.0.0.1:8000 --rps 50   # external server
+
+Without --url the app is imported and served in-process with a threaded WSGI
+server, wired to in-process stubs. With --url, start the server yourself with
+the env printed by `python bench/stubs.py`.
+"""
+import os, sys, json, time, random, argparse, tempfile, threading
+from collections import Counter, defaultdict
+from concurrent.futures import ThreadPoolExecutor
+from typing import Dict, List
+
+import requests
+
+sys.path.insert(0, os.path.dirname(os.path.dirname(os.path.abspath(__file__))))
+import stubs  # noqa: E402  (bench/ is on sys.path when run as a script)
+
+MODES = {"ai": "ai", "web": "web-search"}
+
+_TOPICS = ("solar panels", "rust async runtimes", "sourdough starter", "mars missions",
+           "python packaging", "coral reefs", "electric bikes", "quantum error correction",
+           "tea ceremonies", "volcano monitoring", "postgres indexes", "migratory birds")
+_TEMPLATES = ("What is new with {}?", "Explain {} simply.", "Latest news about {}",
+              "How do {} work?", "Pros and cons of {}")
+
+
+def _question(unique: bool) -> str:
+    q = random.choice(_TEMPLATES).format(random.choice(_TOPICS))
+    return f"{q} #{random.getrandbits(32):x}" if unique else q
+
+
+def _parse_mix(text: str) -> Dict[str, float]:
+    mix = {}
+    for part in text.split(","):
+        name, _, weight = part.partition("=")
+        if name.strip() not in MODES:
+            raise argparse.ArgumentTypeError(f"unknown mode {name!r} (use {', '.join(MODES)})")
+        mix[name.strip()] = float(weight or 1)
+    return mix
+
+
+def _parse_server_timing(header: str) -> Dict[str, float]:
+    """`search;dur=812.3, llm;dur=420.0` -> {"search": 0.8123, "llm": 0.42} (seconds)."""
+    out = {}
+    for metric in filter(None, (m.strip() for m in header.split(","))):
+        name, *params = (p.strip() for p in metric.split(";"))
+        for p in params:
+            if p.startswith("dur="):
+                out[name] = float(p[4:]) / 1000.0
+    return out
+
+
+def _pct(values: List[float], p: float) -> float:
+    if not values:
+        return float("nan")
+    values = sorted(values)
+    return values[min(len(values) - 1, int(round(p / 100.0 * (len(values) - 1))))]
+
+
+def _serve_in_process(args) -> str:
+    server = stubs.serve(stubs.config_from_args(args))
+    stub = f"http://127.0.0.1:{server.server_address[1]}"
+    # Stub answers and bench metrics must not land in the real shared cache or
+    # in the metrics a local server exports, so both get a fresh directory.
+    scratch = tempfile.mkdtemp(prefix="boog-bench-")
+    os.environ.update({
+        "SHARED_CACHE_PATH": os.path.join(scratch, "cache.sqlite3"),
+        "METRICS_DIR": os.path.join(scratch, "metrics"),
+        "TAVILY_URL": f"{stub}/search", "GROQ_BASE_URL": f"{stub}/openai",
+        "TAVILY_API_KEY": os.environ.get("TAVILY_API_KEY", "stub"),
+        "GROQ_API_KEY": os.environ.get("GROQ_API_KEY", "stub"),
+    })
+    import logging
+    from werkzeug.serving import make_server
+    import app as boog
+    logging.getLogger("werkzeug").setLevel(logging.WARNING)
+    boog.warm_up()
+    httpd = make_server("127.0.0.1", 0, boog.app, threaded=True)
+    threading.Thread(target=httpd.serve_forever, name="bench-app", daemon=True).start()
+    return f"http://127.0.0.1:{httpd.server_port}"
+
+
+class Results:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.latency = defaultdict(list)                      # mode -> [s]
+        self.stages = defaultdict(lambda: defaultdict(list))  # mode -> stage -> [s]
+        self.status = Counter()
+        self.stale = 0
+
+    def record(self, mode: str, seconds: float, status, timings: Dict[str, float], stale: bool) -> None:
+        with self.lock:
+            self.status[status] += 1
+            if status != 200:
+                return
+            self.latency[mode].append(seconds)
+            for name, dur in timings.items():
+                self.stages[mode][name].append(dur)
+            self.stale += stale
+
+
+def _fire(session: requests.Session, url: str, mode: str, args, results: Results) -> None:
+    payload = {"message": _question(args.unique), "mode": MODES[mode]}
+    if args.no_cache:
+        payload["no_cache"] = True
+    if args.deadline_ms:
+        payload["deadline_ms"] = args.deadline_ms
+    t0 = time.perf_counter()
+    try:
+        r = session.post(f"{url}/chat", json=payload, timeout=args.timeout)
+        elapsed = time.perf_counter() - t0
+        stale = r.ok and bool(r.json().get("stale"))
+        results.record(mode, elapsed, r.status_code, _parse_server_timing(r.headers.get("Server-Timing", "")), stale)
+    except requests.RequestException as e:
+        results.record(mode, time.perf_counter() - t0, type(e).__name__, {}, False)
+
+
+def run(url: str, args) -> Results:
+    """Open-loop arrivals: requests are launched on schedule regardless of how slow earlier ones are."""
+    results = Results()
+    modes, weights = zip(*args.mix.items())
+    local = threading.local()
+
+    def fire(mode: str) -> None:
+        if not hasattr(local, "session"):
+            local.session = requests.Session()
+        _fire(local.session, url, mode, args, results)
+
+    total = int(args.rps * args.duration)
+    with ThreadPoolExecutor(max_workers=args.concurrency) as pool:
+        start = time.perf_counter()
+        for i in range(total):
+            delay = start + i / args.rps - time.perf_counter()
+            if delay > 0:
+                time.sleep(delay)
+            pool.submit(fire, random.choices(modes, weights)[0])
+    results.wall = time.perf_counter() - start
+    return results
+
+
+def report(results: Results, args) -> None:
+    done = sum(len(v) for v in results.latency.values())
+    print(f"\n{sum(results.status.values())} requests in {results.wall:.1f}s "
+          f"-> {done / results.wall:.1f} ok/s (target {args.rps:g}/s)")
+    print("status:", ", ".join(f"{k}={v}" for k, v in sorted(results.status.items(), key=str)),
+          f"| stale={results.stale}")
+    row = "{:<12}{:<12}{:>7}{:>10}{:>10}{:>10}"
+    print(row.format("mode", "stage", "n", "p50 ms", "p95 ms", "p99 ms"))
+    for mode in sorted(results.latency):
+        series = {"client": results.latency[mode], **results.stages[mode]}
+        for name, values in series.items():
+            print(row.format(mode, name, len(values),
+                             *(f"{_pct(values, p) * 1000:.0f}" for p in (50, 95, 99))))
+    if args.json:
+        with open(args.json, "w") as f:
+            json.dump({"wall_s": results.wall, "status": {str(k): v for k, v in results.status.items()},
+                       "stale": results.stale, "latency": results.latency,
+                       "stages": {m: dict(s) for m, s in results.stages.items()}}, f)
+
+
+def main() -> None:
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--url", help="target an already-running server instead of an in-process one")
+    parser.add_argument("--rps", type=float, default=10.0, help="arrival rate (requests/s)")
+    parser.add_argument("--duration", type=float, default=20.0, help="seconds of load")
+    parser.add_argument("--concurrency", type=int, default=256, help="max in-flight requests")
+    parser.add_argument("--mix", type=_parse_mix, default=_parse_mix("ai=0.5,web=0.5"),
+                        help="mode weights, e.g. ai=0.3,web=0.7")
+    parser.add_argument("--cache", dest="no_cache", action="store_false",
+                        help="let requests hit the answer caches (default: no_cache)")
+    parser.add_argument("--unique", action="store_true", help="append a nonce so no two questions match")
+    parser.add_argument("--deadline-ms", type=int, default=0)
+    parser.add_argument("--timeout", type=float, default=60.0, help="client-side timeout (s)")
+    parser.add_argument("--json", help="also write raw samples to this file")
+    stubs.add_arguments(parser)
+    args = parser.parse_args()
+
+    url = args.url.rstrip("/") if args.url else _serve_in_process(args)
+    print(f"Load: {args.rps:g} req/s for {args.duration:g}s against {url} "
+          f"(mix {args.mix}, {'no_cache' if args.no_cache else 'cached'})")
+    report(run(url, args), args)
+
+
+if __name__ == "__main__":
+    main()
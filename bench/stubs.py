@@ -0,0 +1,187 @@
+"""
+Local stand-ins for the Tavily search API and Groq's OpenAI-compatible chat
+endpoint, so Boog can be load-tested without spending credits.
+
+    python bench/stubs.py --port 8700 --search-latency 0.8 --llm-ttft 0.3 --tokens-per-s 400
+
+then start Boog with
+    TAVILY_URL=http://127.0.0.1:8700/search
+    GROQ_BASE_URL=http://127.0.0.1:8700/openai
+    TAVILY_API_KEY=stub GROQ_API_KEY=stub
+"""
+import json, math, time, random, argparse, threading
+from dataclasses import dataclass
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+
+@dataclass(frozen=True)
+class Latency:
+    """Log-normal latency: `median` seconds, `sigma` spread (0 = fixed)."""
+    median: float
+    sigma: float = 0.0
+
+    def sample(self) -> float:
+        if self.median <= 0:
+            return 0.0
+        return self.median * math.exp(random.gauss(0.0, self.sigma)) if self.sigma else self.median
+
+
+@dataclass
+class StubConfig:
+    search_latency: Latency
+    search_error_rate: float = 0.0
+    llm_ttft: Latency = Latency(0.3, 0.3)
+    llm_error_rate: float = 0.0
+    tokens_per_s: float = 400.0
+    completion_tokens: int = 250
+
+
+_WORDS = ("boog", "cat", "search", "answer", "source", "latency", "token", "stream",
+          "result", "model", "query", "cache", "worker", "network", "budget")
+# Snippets draw from a wider vocabulary so distinct results do not look like
+# near-duplicates to the app's SimHash dedup.
+_VOCAB = tuple(f"{w}{i}" for w in _WORDS for i in range(100))
+
+
+class _Handler(BaseHTTPRequestHandler):
+    protocol_version = "HTTP/1.1"
+    config: StubConfig
+
+    def log_message(self, *args) -> None:  # keep benchmark output clean
+        pass
+
+    def do_HEAD(self) -> None:  # connection prewarming
+        self.send_response(200)
+        self.send_header("Content-Length", "0")
+        self.end_headers()
+
+    def do_POST(self) -> None:
+        body = json.loads(self.rfile.read(int(self.headers.get("Content-Length") or 0)) or b"{}")
+        if self.path.rstrip("/").endswith("/search"):
+            self._search(body)
+        elif self.path.rstrip("/").endswith("/chat/completions"):
+            self._chat(body)
+        else:
+            self._json(404, {"error": "not found"})
+
+    # ----- helpers -----
+    def _json(self, status: int, obj: dict) -> None:
+        data = json.dumps(obj).encode("utf-8")
+        self.send_response(status)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        try:
+            self.wfile.write(data)
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client cancelled (e.g. a hedged request that lost)
+
+    def _chunk(self, data: bytes) -> None:
+        self.wfile.write(b"%x\r\n%s\r\n" % (len(data), data))
+        self.wfile.flush()
+
+    # ----- Tavily -----
+    def _search(self, body: dict) -> None:
+        cfg = self.config
+        time.sleep(cfg.search_latency.sample())
+        if random.random() < cfg.search_error_rate:
+            self._json(503, {"detail": "stub: injected error"})
+            return
+        query = body.get("query", "")
+        n = int(body.get("max_results", 5))
+        results = [{
+            "title": f"Result {i + 1} for {query[:40]}",
+            "url": f"https://example.com/{abs(hash(query)) % 10_000}/{i}",
+            "content": ". ".join(" ".join(random.choice(_VOCAB) for _ in range(12)) for _ in range(5)) + ".",
+            "score": round(1.0 - i * 0.1, 2),
+        } for i in range(n)]
+        self._json(200, {"query": query, "results": results})
+
+    # ----- Groq -----
+    def _chat(self, body: dict) -> None:
+        cfg = self.config
+        time.sleep(cfg.llm_ttft.sample())
+        if random.random() < cfg.llm_error_rate:
+            self._json(503, {"error": {"message": "stub: injected error", "type": "server_error"}})
+            return
+        prompt_tokens = sum(len(m.get("content", "")) for m in body.get("messages", [])) // 4
+        n = cfg.completion_tokens
+        usage = {"prompt_tokens": prompt_tokens, "completion_tokens": n,
+                 "total_tokens": prompt_tokens + n}
+        base = {"id": "stub", "created": int(time.time()), "model": body.get("model", "stub")}
+        per_token = 1.0 / cfg.tokens_per_s if cfg.tokens_per_s > 0 else 0.0
+
+        if not body.get("stream"):
+            time.sleep(n * per_token)
+            text = " ".join(random.choice(_WORDS) for _ in range(n))
+            self._json(200, dict(base, object="chat.completion", usage=usage, choices=[{
+                "index": 0, "finish_reason": "stop",
+                "message": {"role": "assistant", "content": text},
+            }]))
+            return
+
+        self.send_response(200)
+        self.send_header("Content-Type", "text/event-stream")
+        self.send_header("Transfer-Encoding", "chunked")
+        self.end_headers()
+        try:
+            for i in range(n):
+                time.sleep(per_token)
+                chunk = dict(base, object="chat.completion.chunk", choices=[{
+                    "index": 0, "finish_reason": None,
+                    "delta": {"content": random.choice(_WORDS) + " "},
+                }])
+                if i == n - 1:
+                    chunk["x_groq"] = {"id": "stub", "usage": usage}
+                self._chunk(f"data: {json.dumps(chunk)}\n\n".encode("utf-8"))
+            self._chunk(b"data: [DONE]\n\n")
+            self.wfile.write(b"0\r\n\r\n")
+        except (BrokenPipeError, ConnectionResetError):
+            pass  # client cancelled
+
+
+def serve(config: StubConfig, host: str = "127.0.0.1", port: int = 0) -> ThreadingHTTPServer:
+    """Start both stand-ins on one port in a background thread; returns the server."""
+    handler = type("StubHandler", (_Handler,), {"config": config})
+    server = ThreadingHTTPServer((host, port), handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, name="bench-stubs", daemon=True).start()
+    return server
+
+
+def add_arguments(parser: argparse.ArgumentParser) -> None:
+    parser.add_argument("--search-latency", type=float, default=0.8, help="median Tavily latency (s)")
+    parser.add_argument("--search-sigma", type=float, default=0.4, help="log-normal spread of Tavily latency")
+    parser.add_argument("--search-error-rate", type=float, default=0.0)
+    parser.add_argument("--llm-ttft", type=float, default=0.3, help="median Groq time to first token (s)")
+    parser.add_argument("--llm-sigma", type=float, default=0.3)
+    parser.add_argument("--llm-error-rate", type=float, default=0.0)
+    parser.add_argument("--tokens-per-s", type=float, default=400.0, help="Groq generation speed")
+    parser.add_argument("--completion-tokens", type=int, default=250)
+
+
+def config_from_args(args: argparse.Namespace) -> StubConfig:
+    return StubConfig(
+        search_latency=Latency(args.search_latency, args.search_sigma),
+        search_error_rate=args.search_error_rate,
+        llm_ttft=Latency(args.llm_ttft, args.llm_sigma),
+        llm_error_rate=args.llm_error_rate,
+        tokens_per_s=args.tokens_per_s,
+        completion_tokens=args.completion_tokens,
+    )
+
+
+if __name__ == "__main__":
+    parser = argparse.ArgumentParser(description=__doc__, formatter_class=argparse.RawDescriptionHelpFormatter)
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=8700)
+    add_arguments(parser)
+    args = parser.parse_args()
+    server = serve(config_from_args(args), args.host, args.port)
+    base = f"http://{args.host}:{args.port}"
+    print(f"Stubs listening on {base} (Ctrl+C to stop). Start Boog with:\n"
+          f"  TAVILY_URL={base}/search GROQ_BASE_URL={base}/openai TAVILY_API_KEY=stub GROQ_API_KEY=stub")
+    try:
+        threading.Event().wait()
+    except KeyboardInterrupt:
+        server.shutdown()
@@ -0,0 +1,55 @@
+# Picked up automatically by `gunicorn app:app` (see Procfile).
+import os, json, shutil, tempfile
+
+
+def _setting(name, default=None):
+    # Same lookup as app.py (env, then BOOG_CONFIG), without importing the app
+    # into the master process.
+    value = os.getenv(name)
+    if value is None and os.getenv("BOOG_CONFIG"):
+        try:
+            with open(os.environ["BOOG_CONFIG"], encoding="utf-8") as f:
+                value = json.load(f).get(name)
+        except (OSError, ValueError, AttributeError):
+            pass
+    return default if value is None else value
+
+
+def _metrics_dir():
+    return _setting("METRICS_DIR") or os.path.join(tempfile.gettempdir(), "boog-metrics")
+
+
+# Threaded workers with a thread for every admitted and queued chat plus
+# GUNICORN_HEADROOM more, so that under load requests wait (and are shed with
+# 503 + Retry-After) in the app's admission control, and /metrics still
+# answers. gthread accepts up to worker_connections sockets and parks those it
+# has no thread for where the app cannot see them, so it is capped at the
+# thread count (which turns off keep-alive, hence gunicorn's warning):
+# anything beyond stays in the listen backlog. `-k` on the
+# command line (e.g. the async worker) still takes precedence.
+worker_class = "gthread"
+threads = max(2, int(_setting("GUNICORN_THREADS", 0)) or (
+    int(_setting("ADMIT_CONCURRENCY", 32)) + int(_setting("ADMIT_QUEUE", 64))
+    + int(_setting("GUNICORN_HEADROOM", 16))))
+worker_connections = threads
+
+
+def on_starting(server):
+    # Worker metric snapshots from a previous master run are stale.
+    shutil.rmtree(_metrics_dir(), ignore_errors=True)
+
+
+def post_worker_init(worker):
+    # Runs in each worker after fork, once app.py is loaded: open the
+    # upstream connection pools before the first /chat arrives.
+    from app import warm_up
+    warm_up()
+
+
+def worker_exit(server, worker):
+    # Keep the final counters of a worker that is recycled or shut down.
+    from app import metrics
+    try:
+        metrics.flush()
+    except OSError:
+        pass